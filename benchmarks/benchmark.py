@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+Check HTTP JSON Nagios Plugin benchmarks
+
+Measures the rule engine, the fetch path and the cold start of check_http_json.py against synthetic
+documents shaped like Hadoop /jmx beans, Dropwizard gauges and Riak stats, served by a local HTTP server.
+Results are written as JSON so that numbers can be compared between versions, e.g.
+
+    ./benchmarks/benchmark.py --output before.json --plugin /tmp/old/check_http_json.py
+    ./benchmarks/benchmark.py --output after.json --compare before.json
+
+Only the JsonRuleProcessor/JsonHelper/NagiosHelper interface and the command line are used,
+so older versions of the plugin can be measured as well.
+"""
+
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'check_http_json.py')
+SIZES = {'small': 100, 'medium': 2000, 'large': 20000}
+RULE_COUNTS = (10, 100, 500)
+
+
+def jmxDocument(size):
+    """Hadoop style {"beans": [...]} where rules select beans by name"""
+    beans = []
+    for i in range(size):
+        beans.append({
+            "name": "Hadoop:service=NameNode,name=Bean%d" % i,
+            "modelerType": "org.apache.hadoop.metrics.Bean%d" % i,
+            "tag.Context": "dfs",
+            "Value": i % 1000,
+            "Counts": [i, i + 1, i + 2],
+        })
+    return {"beans": beans}
+
+def jmxRules(size, count):
+    rules = []
+    for i in range(count):
+        bean = (i * 7919) % size
+        if i % 2:
+            name = base64.b64encode(("Hadoop:service=NameNode,name=Bean%d" % bean).encode()).decode()
+            rules.append("beans.(name=%s).Value,0:1000" % name)
+        else:
+            rules.append("beans(%d).Counts(1),0:%d" % (bean, size + 10))
+    return rules, '.'
+
+def dropwizardDocument(size):
+    """Dropwizard metrics style {"gauges": {"dotted.name": {"value": n}}}, addressed with -f _"""
+    return {
+        "version": "4.0.0",
+        "gauges": dict(("jvm.memory.pool%d.used" % i, {"value": i * 1024}) for i in range(size)),
+        "counters": dict(("requests.endpoint%d" % i, {"count": i}) for i in range(size // 10 + 1)),
+    }
+
+def dropwizardRules(size, count):
+    return ["gauges_jvm.memory.pool%d.used_value,0:%d" % ((i * 7919) % size, size * 1024) for i in range(count)], '_'
+
+def riakDocument(size):
+    """Riak /stats style flat dict of counters plus a few lists"""
+    document = dict(("node_stat_%d" % i, i) for i in range(size))
+    document["ring_members"] = ["riak%d@127.0.0.1" % i for i in range(5)]
+    document["connected_nodes"] = ["riak%d@127.0.0.1" % i for i in range(1, 5)]
+    return document
+
+def riakRules(size, count):
+    return ["node_stat_%d,0:%d" % ((i * 7919) % size, size) for i in range(count)], '.'
+
+SHAPES = {
+    'jmx': (jmxDocument, jmxRules),
+    'dropwizard': (dropwizardDocument, dropwizardRules),
+    'riak': (riakDocument, riakRules),
+}
+
+
+class Rules:
+    """Stand-in for the parsed command line, with every rule list empty"""
+    field_type = 'str'
+    debug = False
+    top_violators = 5
+    key_threshold_warning, key_value_list, key_list, key_threshold_critical, \
+    key_value_list_critical, key_list_critical, metric_list = None, None, None, None, None, None, None
+
+    def __init__(self, thresholds, separator):
+        self.separator = separator
+        self.key_threshold_critical = thresholds
+        self.metric_list = [threshold.split(',')[0] for threshold in thresholds]
+
+
+def loadPlugin(path):
+    spec = importlib.util.spec_from_file_location('check_http_json', path)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+def serve(documents):
+    """Start a local stand-in HTTP server for {path: body} and return it"""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            body = documents.get(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body or b'')))
+            self.end_headers()
+            self.wfile.write(body or b'')
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.documents = documents
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def best(function, repeat, number=1):
+    """Best wall time in seconds of number calls, over repeat rounds"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - started) / number)
+    return min(timings)
+
+def runEngine(plugin, data, rules):
+    nagios = plugin.NagiosHelper()
+    processor = plugin.JsonRuleProcessor(data, rules)
+    nagios.append_warning(*processor.checkWarning())
+    nagios.append_critical(*processor.checkCritical())
+    nagios.append_metrics(*processor.checkMetrics())
+    return nagios.getCode()
+
+def lookups(plugin, data, keys, separator):
+    helper = plugin.JsonHelper(data, separator)
+    for key in keys:
+        helper.get(key)
+
+def peakMemory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def runCommand(command):
+    started = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started, result.returncode
+
+def benchmarkCase(plugin, plugin_path, server, shape, size_name, rule_count, repeat):
+    make_document, make_rules = SHAPES[shape]
+    size = SIZES[size_name]
+    document = make_document(size)
+    body = json.dumps(document)
+    thresholds, separator = make_rules(size, rule_count)
+    keys = [threshold.split(',')[0] for threshold in thresholds]
+    path = '/%s-%s' % (shape, size_name)
+    server.documents[path] = body.encode()
+
+    data = json.loads(body)
+    rules = Rules(thresholds, separator)
+    parse = best(lambda: json.loads(body), repeat)
+    engine = best(lambda: runEngine(plugin, data, rules), repeat)
+    lookup = best(lambda: lookups(plugin, data, keys, separator), repeat)
+    peak = peakMemory(lambda: runEngine(plugin, json.loads(body), rules))
+
+    command = [sys.executable, plugin_path, '-H', '127.0.0.1', '-P', str(server.server_address[1]), '-p', path[1:],
+               '-f', separator, '-c'] + thresholds
+    check = [runCommand(command) for _ in range(repeat)]
+    return {
+        'shape': shape,
+        'size': size_name,
+        'items': size,
+        'rules': rule_count,
+        'document_bytes': len(body),
+        'parse_ms': parse * 1000,
+        'engine_ms': engine * 1000,
+        'lookups_per_s': len(keys) / lookup if lookup else None,
+        'peak_memory_kib': peak / 1024,
+        'check_ms': statistics.median(duration for duration, _ in check) * 1000,
+        'check_code': check[0][1],
+    }
+
+def benchmarkColdStart(plugin_path, server, repeat):
+    """Median wall time of the interpreter alone, of the plugin without arguments and of small -i and HTTP checks,
+    run interleaved so that a change in machine load affects them alike"""
+    import tempfile
+    body = b'{"status": "UP", "metric": 5}'
+    server.documents['/cold'] = body
+    with tempfile.NamedTemporaryFile(suffix='.json') as document:
+        document.write(body)
+        document.flush()
+        commands = {
+            'interpreter': [sys.executable, '-c', 'pass'],
+            # Argument errors exit before any rule or network work, so this is import and argparse time
+            'plugin': [sys.executable, plugin_path],
+            'input': [sys.executable, plugin_path, '-i', document.name, '-q', 'status,UP', '-w', 'metric,0:10'],
+            'http': [sys.executable, plugin_path, '-H', '127.0.0.1', '-P', str(server.server_address[1]), '-p', 'cold',
+                     '-q', 'status,UP', '-w', 'metric,0:10'],
+        }
+        durations = dict((name, []) for name in commands)
+        for _ in range(repeat):
+            for name, command in commands.items():
+                durations[name].append(runCommand(command)[0])
+    results = dict(('%s_ms' % name, statistics.median(values) * 1000) for name, values in durations.items())
+    results['overhead_ms'] = results['plugin_ms'] - results['interpreter_ms']
+    return results
+
+def gitRevision(path):
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(path)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """Print every metric as a ratio of the baseline, below 1.0 is faster or smaller"""
+    baseline_cases = dict(((case['shape'], case['size'], case['rules']), case) for case in baseline['cases'])
+    print('%-12s %-7s %5s %10s %10s %10s %10s' % ('shape', 'size', 'rules', 'engine', 'lookups', 'memory', 'check'))
+    for case in results['cases']:
+        old = baseline_cases.get((case['shape'], case['size'], case['rules']))
+        if old is None:
+            continue
+        ratio = lambda metric: case[metric] / old[metric] if old[metric] else float('nan')
+        print('%-12s %-7s %5d %9.2fx %9.2fx %9.2fx %9.2fx' % (case['shape'], case['size'], case['rules'],
+              ratio('engine_ms'), old['lookups_per_s'] / case['lookups_per_s'], ratio('peak_memory_kib'), ratio('check_ms')))
+    for metric in ('overhead_ms', 'input_ms', 'http_ms'):
+        if metric in baseline['cold_start']:
+            print('cold start %s %.1fms -> %.1fms' % (metric[:-3], baseline['cold_start'][metric], results['cold_start'][metric]))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Benchmark check_http_json.py and write the results as JSON.')
+    parser.add_argument('--plugin', default=DEFAULT_PLUGIN, help='Plugin to measure, defaults to the one in this repository.')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='Results file, defaults to benchmark.json.')
+    parser.add_argument('--compare', help='Print the results relative to this earlier results file.')
+    parser.add_argument('--shapes', nargs='*', default=sorted(SHAPES), choices=sorted(SHAPES))
+    parser.add_argument('--sizes', nargs='*', default=list(SIZES), choices=list(SIZES))
+    parser.add_argument('--rules', nargs='*', type=int, default=list(RULE_COUNTS))
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Rounds per measurement, the best or median is kept.')
+    return parser.parse_args()
+
+"""Program entry point"""
+if __name__ == "__main__":
+    args = parseArgs()
+    plugin_path = os.path.abspath(args.plugin)
+    plugin = loadPlugin(plugin_path)
+    server = serve({})
+    results = {
+        'plugin': plugin_path,
+        'revision': gitRevision(plugin_path),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'cold_start': benchmarkColdStart(plugin_path, server, args.repeat),
+        'cases': [],
+    }
+    for shape in args.shapes:
+        for size_name in args.sizes:
+            for rule_count in args.rules:
+                case = benchmarkCase(plugin, plugin_path, server, shape, size_name, rule_count, args.repeat)
+                results['cases'].append(case)
+                print('%(shape)-12s %(size)-7s %(rules)5d rules  engine %(engine_ms)8.2fms  %(lookups_per_s)10.0f lookups/s'
+                      '  peak %(peak_memory_kib)8.0fKiB  check %(check_ms)8.1fms' % case)
+    server.shutdown()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('cold start: interpreter %(interpreter_ms).1fms, plugin %(plugin_ms).1fms, -i check %(input_ms).1fms,'
+          ' HTTP check %(http_ms).1fms' % results['cold_start'])
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
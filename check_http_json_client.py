@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+Check HTTP JSON Nagios Plugin client
+
+Forwards its arguments to a check_http_json.py --daemon over a Unix socket, then prints the
+plugin output and exits with the plugin code. It only imports what it needs to talk to the daemon,
+so checks skip the interpreter startup cost of the full plugin.
+
+Usage: check_http_json_client.py [--socket SOCKET] <check_http_json.py arguments>
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+UNKNOWN_CODE = 3
+DEFAULT_SOCKET = os.environ.get('CHECK_HTTP_JSON_SOCKET', '/var/run/check_http_json.sock')
+# Seconds to wait for the daemon's answer, below the 60s Nagios service_check_timeout by default
+DEFAULT_TIMEOUT = float(os.environ.get('CHECK_HTTP_JSON_TIMEOUT', 55))
+
+
+def forward(socket_path, argv, timeout=DEFAULT_TIMEOUT):
+    """Send argv and the working directory to the daemon and return its (code, output, debug) answer"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n').encode())
+        with sock.makefile('rb') as f:
+            reply = json.loads(f.readline().decode())
+    return reply['code'], reply['output'], reply.get('debug', '')
+
+"""Program entry point"""
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    socket_path = DEFAULT_SOCKET
+    if len(argv) >= 2 and argv[0] == '--socket':
+        socket_path, argv = argv[1], argv[2:]
+    debug = ''
+    try:
+        code, output, debug = forward(socket_path, argv)
+    except socket.timeout:
+        code, output = UNKNOWN_CODE, "UNKNOWN: check_http_json daemon at %s did not answer within %gs" % (socket_path, DEFAULT_TIMEOUT)
+    except (OSError, ValueError, KeyError) as e:
+        code, output = UNKNOWN_CODE, "UNKNOWN: check_http_json daemon at %s did not answer (%s)" % (socket_path, e)
+    sys.stdout.write(debug)
+    print(output)
+    exit(code)
@@ -0,0 +1,2626 @@
+"""
+Check HTTP JSON Nagios Plugin engine
+
+The plugin itself, run by the check_http_json.py launcher next to it. Python caches the bytecode of an imported
+module but compiles a script on every run, so the code lives here rather than in the script.
+"""
+
+# Only what the rule engine needs is imported here. The HTTP stack, argparse and the batch, daemon and cache
+# modules are imported by the functions using them, so failing or --input checks start without loading them.
+# Regular expressions are compiled on first use by the re module's cache.
+import codecs
+import json
+import os
+import re
+import sys
+import time
+
+
+OK_CODE = 0
+WARNING_CODE = 1
+CRITICAL_CODE = 2
+UNKNOWN_CODE = 3
+
+
+def TypeHelper(value, field_type):
+    def get_size(b, system):
+        for factor, suffix in system:
+            if b >= factor:
+                break
+        amount = int(b/factor)
+        return str(amount) + suffix
+
+    if field_type == 'size':
+        return get_size(int(value), [(1024 ** 5, ' PiB'), (1024 ** 4, ' TiB'), (1024 ** 3, ' GiB'), (1024 ** 2, ' MiB'), (1024 ** 1, ' KiB'), (1024 ** 0, ' bytes')])
+    if field_type.lower() == 'si':
+        return get_size(int(value), [(1000 ** 5, 'P'), (1000 ** 4, 'T'), (1000 ** 3, 'G'), (1000 ** 2, 'M'), (1000 ** 1, 'K'), (1000 ** 0, 'B')])
+
+    assert(field_type == 'str')
+    return str(value)
+
+class NagiosHelper:
+    """Help with Nagios specific status string formatting."""
+    message_prefixes = {OK_CODE: 'OK', WARNING_CODE: 'WARNING', CRITICAL_CODE: 'CRITICAL', UNKNOWN_CODE: 'UNKNOWN'}
+    perfdata_entry = r"(?:'[^']*(?:''[^']*)*'|[^\s'])+"
+    perfdata_label = r"'((?:[^']|'')*)'=|([^=]*)="
+
+    def __init__(self, long_output=False, max_output=0):
+        self.long_output = long_output
+        self.max_output = max_output
+        self.details = []
+        self.warnings = []
+        self.criticals = []
+        self.unknowns = []
+        self.perfdata = []
+        # Set when a policy, like a cluster quorum, decides the state instead of the messages
+        self.code = None
+        # Leads the output right after the state, like the quorum line deciding it
+        self.summary = ''
+
+    @staticmethod
+    def extend(parts, message):
+        """Add a message, either a string or a list of strings and callables returning one, skipping empty strings"""
+        if isinstance(message, str):
+            if message:
+                parts.append(message)
+        else:
+            parts.extend(part for part in message if part != '')
+
+    @staticmethod
+    def text(part):
+        return part() if callable(part) else part
+
+    @staticmethod
+    def label(text):
+        """Quote a performance data label, doubling its single quotes as the plugin guidelines ask"""
+        return "'%s'" % text.replace("'", "''")
+
+    def getMessage(self):
+        """Build a status-prefixed message with optional performance data generated externally"""
+        prefix = "%s:%s" % (self.message_prefixes[self.getCode()], self.summary)
+        problems = self.criticals + self.warnings + self.unknowns
+        if self.long_output:
+            render = self.renderLong
+            perfdata = [entry for chunk in self.perfdata for entry in re.findall(self.perfdata_entry, chunk)]
+        else:
+            render = self.renderLine
+            perfdata = self.perfdata
+        if not self.max_output:
+            return render(prefix, [self.text(part) for part in self.details], problems, perfdata)
+        return self.fit(render, prefix, problems, perfdata)
+
+    @staticmethod
+    def renderLine(prefix, details, problems, perfdata, notes=(), passed=None):
+        text = prefix + ''.join(details) + ''.join(problems) + ''.join(notes)
+        if perfdata:
+            text += "|%s" % ''.join(perfdata)
+        return text
+
+    @staticmethod
+    def renderLong(prefix, details, problems, perfdata, notes=(), passed=None):
+        """Problems on the first line, one detail per line below, then one performance data entry per line"""
+        if problems:
+            lines = [prefix + ''.join(problems)]
+        else:
+            lines = ["%s %d checks passed." % (prefix, len(details) if passed is None else passed)]
+        lines.extend(detail.strip() for detail in details)
+        lines.extend(note.strip() for note in notes)
+        if perfdata and len(lines) == 1:
+            # Nagios only reads performance data from later lines after a "|" on one of them
+            lines[0] += "|%s" % ' '.join(perfdata)
+        elif perfdata:
+            lines[-1] += "|%s" % perfdata[0]
+            lines.extend(perfdata[1:])
+        return '\n'.join(lines)
+
+    def fit(self, render, prefix, problems, perfdata):
+        """Render within max_output bytes, dropping details first, then problems, then performance data entries"""
+        size = lambda text: len(text.encode('utf-8'))
+        passed = len(self.details)
+        details = []
+        room = self.max_output - size(render(prefix, [], problems, perfdata))
+        separator = 1 if self.long_output else 0
+        for part in self.details:
+            text = self.text(part)
+            room -= size(text) + separator
+            if room < 0:
+                break
+            details.append(text)
+        else:
+            message = render(prefix, details, problems, perfdata)
+            if size(message) <= self.max_output:
+                return message
+        # Over budget, keep what fits next to notes about what was left out, leaving room for the longest notes
+        omitted = lambda count, what: [" %d more %s omitted." % (count, what)] if count else []
+        room = self.max_output - size(render(prefix, [], omitted(len(problems), 'problems'), perfdata, omitted(passed, 'details'), passed))
+        if room >= 0:
+            kept_problems = self.fitting(problems, room, size)
+            room -= sum(size(problem) + 1 for problem in problems[:kept_problems])
+            details = details[:self.fitting(details, room, size)]
+            # The problems note stays with the problems, so it leads the long output
+            return render(prefix, details, problems[:kept_problems] + omitted(len(problems) - kept_problems, 'problems'), perfdata,
+                          omitted(passed - len(details), 'details'), passed)
+        # The notes do not fit next to the performance data, keep the entries that fit next to the problems note
+        problems = [" %d problems omitted." % len(problems)] if problems else []
+        entries = [entry + ('' if self.long_output else ' ') for chunk in perfdata for entry in re.findall(self.perfdata_entry, chunk)]
+        room = self.max_output - size(render(prefix, [], problems, [], (), passed))
+        kept = 0
+        for entry in entries:
+            # The first entry follows a "|", the others a line break in long output
+            room -= size(entry) + (1 if separator or not kept else 0)
+            if room < 0:
+                break
+            kept += 1
+        return render(prefix, [], problems, entries[:kept], (), passed)
+
+    @staticmethod
+    def fitting(parts, room, size):
+        """Return how many leading parts fit into room bytes, counting a line break after each"""
+        for kept, part in enumerate(parts):
+            room -= size(part) + 1
+            if room < 0:
+                return kept
+        return len(parts)
+
+    def include(self, other, node):
+        """Add the messages and performance data of another result, labelled with its node like a (*) match"""
+        prefix = lambda part: " %s: %s" % (node, self.text(part).lstrip())
+        for parts, others in ((self.warnings, other.warnings), (self.criticals, other.criticals), (self.unknowns, other.unknowns)):
+            parts.extend(prefix(part) for part in others)
+        self.details.extend((lambda part=part: prefix(part)) for part in other.details)
+        for chunk in other.perfdata:
+            for entry in re.findall(self.perfdata_entry, chunk):
+                match = re.match(self.perfdata_label, entry)
+                label = match.group(1).replace("''", "'") if match.group(1) is not None else match.group(2)
+                self.perfdata.append("%s=%s " % (self.label("%s(%s)" % (label, node)), entry[match.end():]))
+
+    def getCode(self):
+        if self.code is not None:
+            return self.code
+        code = OK_CODE
+        if self.warnings:
+            code = WARNING_CODE
+        if self.criticals:
+            code = CRITICAL_CODE
+        if self.unknowns:
+            code = UNKNOWN_CODE
+        return code
+
+    def append_warning(self, warning_message, status_message):
+        self.extend(self.warnings, warning_message)
+        self.extend(self.details, status_message)
+
+    def append_critical(self, critical_message, status_message):
+        self.extend(self.criticals, critical_message)
+        self.extend(self.details, status_message)
+
+    def append_unknown(self, unknown_message, status_message):
+        self.extend(self.unknowns, unknown_message)
+        self.extend(self.details, status_message)
+
+    def append_metrics(self, performance_data, warning_message, critical_message):
+        self.extend(self.perfdata, performance_data)
+        self.append_warning(warning_message, '')
+        self.append_critical(critical_message, '')
+
+NOT_FOUND = (None, 'not_found')
+FETCH_FAILED = (None, 'fetch_failed')
+# Entries kept by the in-memory caches, which a long running --daemon fills with every distinct check
+MEMO_SIZE = 1024
+
+def remember(memo, key, value):
+    """Store value in memo under key, emptying memo first once it holds MEMO_SIZE entries, and return it"""
+    if len(memo) >= MEMO_SIZE:
+        memo.clear()
+    memo[key] = value
+    return value
+
+class Matches(list):
+    """Values collected by a wildcard path, as (labels, value) pairs in document order"""
+    def __init__(self, items=()):
+        list.__init__(self, items)
+        self._numbers = None
+
+    def numbers(self):
+        """Return (float, labels, value) for every numeric value, converting each value only once"""
+        if self._numbers is None:
+            self._numbers = []
+            for labels, value in self:
+                try:
+                    self._numbers.append((float(value), labels, value))
+                except (TypeError, ValueError):
+                    pass
+        return self._numbers
+
+    @staticmethod
+    def label(alias, labels):
+        """Substitute the (*) segments of alias with the array indexes or object keys of one match"""
+        if JsonPath.wildcard not in alias:
+            return alias + ''.join('(%s)' % label for label in labels)
+        for label in labels:
+            alias = alias.replace(JsonPath.wildcard, '(%s)' % label, 1)
+        return alias
+
+def _aggregate(function, value):
+    """Reduce a wildcard match or a JSON array to a single number"""
+    if isinstance(value, list) and not isinstance(value, Matches):
+        value = Matches(((i,), element) for i, element in enumerate(value))
+    if not isinstance(value, Matches):
+        return NOT_FOUND
+    if function.startswith('count='):
+        values = function[len('count='):].split(':')
+        return sum(1 for _, v in value if str(v) in values)
+    numbers = [number for number, _, _ in value.numbers()]
+    if function == 'count':
+        return len(value)
+    if function == 'sum':
+        result = sum(numbers)
+    elif not numbers:
+        return NOT_FOUND
+    elif function == 'min':
+        result = min(numbers)
+    elif function == 'max':
+        result = max(numbers)
+    elif function == 'avg':
+        result = sum(numbers) / len(numbers)
+    else:
+        # Nearest-rank percentile, e.g. p95
+        import math
+        numbers.sort()
+        rank = int(math.ceil(float(function[1:]) / 100 * len(numbers)))
+        result = numbers[min(max(rank, 1), len(numbers)) - 1]
+    if isinstance(result, float) and result.is_integer():
+        result = int(result)
+    return result
+
+class JsonPath:
+    """A key compiled once into segments, with its (*) wildcards, #function aggregate and #rate/#delta counter suffix"""
+    NAME, INDEX, SELECT, WILDCARD = 'name', 'index', 'select', 'wildcard'
+    arrayOpener = '('
+    arrayCloser = ')'
+    wildcard = '(*)'
+    aggregateMarker = '#'
+    aggregates = r'^(count(=.*)?|sum|min|max|avg|p\d+(\.\d+)?)$'
+    # Anything else looking like a percentile, e.g. p-5 or p.5, is a mistake rather than part of a key name
+    percentile = r'^p[-+.]?[0-9]'
+    counters = ('rate', 'delta')
+    _compiled = {}
+
+    @classmethod
+    def compile(cls, key, separator):
+        """Return the compiled path for key, parsing it only the first time it is seen"""
+        path = cls._compiled.get((key, separator))
+        if path is None:
+            path = remember(cls._compiled, (key, separator), cls(key, separator))
+        return path
+
+    @classmethod
+    def splitCounter(cls, key):
+        """Return key without its #rate or #delta suffix, and that counter function or None"""
+        path, marker, function = key.rpartition(cls.aggregateMarker)
+        if marker and function in cls.counters:
+            return path, function
+        return key, None
+
+    def __init__(self, key, separator):
+        self.key = key
+        self.separator = separator
+        self.aggregate = None
+        key, self.counter = self.splitCounter(key)
+        self.base = key
+        if self.aggregateMarker in key:
+            path, function = key.rsplit(self.aggregateMarker, 1)
+            if re.match(self.aggregates, function):
+                key, self.aggregate = path, function
+            elif re.match(self.percentile, function):
+                raise ValueError("#%s in %s is not a percentile between 0 and 100" % (function, self.key))
+            if self.aggregate and self.aggregate[0] == 'p' and not 0 < float(self.aggregate[1:]) <= 100:
+                raise ValueError("#%s in %s is not a percentile between 0 and 100" % (self.aggregate, self.key))
+        self.segments = self.parse(key)
+
+    def parse(self, key):
+        segments = []
+        while key:
+            separatorIndex = key.find(self.separator)
+            openerIndex = key.find(self.arrayOpener)
+            if separatorIndex != -1 and (openerIndex == -1 or separatorIndex < openerIndex):
+                segments.append((self.NAME, key[:separatorIndex]))
+                key = key[separatorIndex + len(self.separator):]
+            elif openerIndex != -1:
+                closerIndex = key.find(self.arrayCloser, openerIndex)
+                if closerIndex == -1:
+                    closerIndex = len(key)
+                if openerIndex > 0:
+                    segments.append((self.NAME, key[:openerIndex]))
+                segments.append(self.parseSelector(key[openerIndex + 1:closerIndex]))
+                key = key[closerIndex + 1:]
+                if key.startswith(self.separator):
+                    key = key[len(self.separator):]
+            else:
+                segments.append((self.NAME, key))
+                key = ''
+        return segments
+
+    def parseSelector(self, k):
+        if k.isdecimal():  # isdigit() for py2
+            return (self.INDEX, int(k))
+        if k == '*':
+            return (self.WILDCARD, None)
+        # k is of type: name=val
+        # val might be e.g. "Hadoop:service=Resource Manager (Stuff),name=RMNMInfo",
+        # which is a hell to parse, so we base64 en/decode val to make parsing easier.
+        import base64
+        n, v = k.split("=", 1)
+        v = base64.b64decode(v).decode()
+        return (self.SELECT, (JsonPath.compile(n, self.separator), str(v)))
+
+    def resolve(self, data, indexes=None):
+        """Walk data along the compiled segments. Returns NOT_FOUND if any segment is missing"""
+        value = self.walk(data, 0, indexes)
+        if self.aggregate:
+            return _aggregate(self.aggregate, value)
+        return value
+
+    def walk(self, data, start, indexes):
+        for position in range(start, len(self.segments)):
+            kind, arg = self.segments[position]
+            if kind == self.NAME:
+                if not isinstance(data, dict) or arg not in data:
+                    return NOT_FOUND
+                data = data[arg]
+            elif kind == self.INDEX:
+                if not isinstance(data, list) or arg >= len(data):
+                    return NOT_FOUND
+                data = data[arg]
+            elif kind == self.WILDCARD:
+                if isinstance(data, dict):
+                    children = data.items()
+                elif isinstance(data, list):
+                    children = enumerate(data)
+                else:
+                    return NOT_FOUND
+                matches = Matches()
+                for label, child in children:
+                    value = self.walk(child, position + 1, indexes)
+                    if isinstance(value, Matches):
+                        matches.extend(((label,) + labels, v) for labels, v in value)
+                    elif value != NOT_FOUND:
+                        matches.append(((label,), value))
+                return matches if matches or self.aggregate else NOT_FOUND
+            else:
+                field, value = arg
+                if not isinstance(data, list):
+                    return NOT_FOUND
+                if indexes is None:
+                    for element in data:
+                        if str(field.resolve(element)) == value:
+                            data = element
+                            break
+                    else:
+                        return NOT_FOUND
+                else:
+                    index = indexes.get((id(data), field.key))
+                    if index is None:
+                        index = indexes[(id(data), field.key)] = self.indexArray(data, field)
+                    if value not in index:
+                        return NOT_FOUND
+                    data = data[index[value]]
+        return data
+
+    @staticmethod
+    def indexArray(data, field):
+        """Map str(element[field]) to the position of the first element holding that value"""
+        index = {}
+        for i, element in enumerate(data):
+            index.setdefault(str(field.resolve(element)), i)
+        return index
+
+class JsonHelper:
+    """Perform simple comparison operations against values in a given JSON dict"""
+    def __init__(self, json_data, separator):
+        self.data = json_data
+        self.separator = separator
+        self.arrayOpener = JsonPath.arrayOpener
+        self.arrayCloser = JsonPath.arrayCloser
+        self.resolved = {}
+        self.indexes = {}
+        self.walks = 0
+        # How many values the aggregate of a key reduced, for --trace
+        self.reduced = {}
+
+    def equals(self, key, value): return self.exists(key) and str(self.get(key)) in value.split(':')
+    def lte(self, key, value): return self.exists(key) and float(self.get(key)) <= float(value)
+    def lt(self, key, value): return self.exists(key) and float(self.get(key)) < float(value)
+    def gte(self, key, value): return self.exists(key) and float(self.get(key)) >= float(value)
+    def gt(self, key, value): return self.exists(key) and float(self.get(key)) > float(value)
+    def exists(self, key): return (self.get(key) != NOT_FOUND)
+    def get(self, key, temp_data=None):
+        """Can navigate nested json keys with a dot format (Element.Key.NestedKey). Returns (None, 'not_found') if not found"""
+        path = JsonPath.compile(key, self.separator)
+        if temp_data is not None:
+            return path.resolve(temp_data)
+        # key#rate and key#delta read the same value as key
+        if path.base not in self.resolved:
+            self.walks += 1
+            value = path.walk(self.data, 0, self.indexes)
+            if path.aggregate:
+                self.reduced[path.base] = len(value) if isinstance(value, list) else 0
+                value = _aggregate(path.aggregate, value)
+            self.resolved[path.base] = value
+        return self.resolved[path.base]
+
+def touchedSubtrees(data, paths):
+    """Return the parts of data reached by paths for --debug, arrays as {index: element} dicts"""
+    touched = NOT_FOUND
+    for segments in paths:
+        touched = _touch(data, segments, touched)
+    return {} if touched is NOT_FOUND else touched
+
+def _touch(data, segments, touched):
+    """Merge what segments reach from data into touched, the part of data already reached by other keys"""
+    if not segments or touched is data:
+        return data
+    if not isinstance(data, (dict, list)):
+        return touched
+    kind, arg = segments[0]
+    if kind == JsonPath.NAME:
+        children = [arg] if isinstance(data, dict) and arg in data else []
+    elif kind == JsonPath.INDEX:
+        children = [arg] if isinstance(data, list) and arg < len(data) else []
+    elif kind == JsonPath.WILDCARD:
+        children = list(data) if isinstance(data, dict) else range(len(data))
+    else:
+        field, value = arg
+        children = [i for i, element in enumerate(data) if str(field.resolve(element)) == value][:1] if isinstance(data, list) else []
+    for child in children:
+        subtree = _touch(data[child], segments[1:], touched.get(child, NOT_FOUND) if isinstance(touched, dict) else NOT_FOUND)
+        if subtree is not NOT_FOUND:
+            if not isinstance(touched, dict):
+                touched = {}
+            touched[child] = subtree
+    return touched
+
+def _getKeyAlias(original_key):
+    key = original_key
+    alias = original_key
+    if '>' in original_key:
+        keys = original_key.split('>')
+        if len(keys) == 2:
+            key, alias = keys
+    return key, alias
+
+JSON_BACKENDS = ('orjson', 'ujson', 'json')
+# Importing a faster decoder takes 10-20ms and saves about 5ms per MB, smaller documents are left to json
+FAST_DECODER_MIN_SIZE = 4 * 1024 * 1024
+# Integers this long may not fit the 64 bits of other decoders, orjson even turns them into floats silently
+_long_number = rb'[0-9]{19}'
+
+_decoders = {}
+
+def jsonDecoder(backend=None):
+    """Return the name and loads() function of the JSON backend, the first installed one of JSON_BACKENDS unless one is forced"""
+    decoder = _decoders.get(backend)
+    if decoder is None:
+        decoder = _decoders[backend] = _findDecoder(backend)
+    return decoder
+
+def _findDecoder(backend):
+    for name in [backend] if backend else JSON_BACKENDS:
+        if name == 'json':
+            return name, json.loads
+        try:
+            return name, __import__(name).loads
+        except ImportError:
+            if backend:
+                raise
+    return 'json', json.loads
+
+def loadJson(body, backend=None, size=None):
+    """Parse a JSON document from bytes, with the fastest available backend once it, or the size of its stream, is large enough"""
+    if backend is None and (len(body) if size is None else size) < FAST_DECODER_MIN_SIZE:
+        return json.loads(body)
+    name, loads = jsonDecoder(backend)
+    if name != 'json' and re.search(_long_number, body) is None:
+        try:
+            return loads(body)
+        except ValueError:
+            # NaN, Infinity, floats out of range, lone surrogates or a byte order mark
+            pass
+    return json.loads(body)
+
+def _ruleKeys(rules):
+    """Return the keys, without aliases, that the rules in rules_args refer to"""
+    return list(RuleProgram.fromArgs(rules).keys)
+
+def _rulePaths(args, names=()):
+    """Return the segment lists of the rule keys, less the leading segments matching names"""
+    paths = [JsonPath.compile(key, args.separator or '.').segments for key in _ruleKeys(args)]
+    for name in names:
+        paths = [segments[1:] for segments in paths
+                 if not segments or segments[0] in ((JsonPath.NAME, name), (JsonPath.WILDCARD, None))]
+    return paths
+
+class StreamingProjector:
+    """Parse a JSON document from a byte stream, keeping only the subtrees the given paths refer to"""
+    number_chars = frozenset('0123456789.eE+-')
+
+    def __init__(self, stream, paths, chunk_size=64 * 1024, backend=None):
+        """paths are the segment lists of the compiled keys to keep"""
+        self.stream = stream
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.whitespace = re.compile(r'[ \t\n\r]*')
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.size = 0
+        self.eof = False
+        self.projection = self.buildProjection(paths)
+        self.leaves = self.countLeaves(self.projection)
+        self.satisfied = set()
+
+    # Projection key applying its subtree to every element of an array or value of an object
+    EACH = (JsonPath.WILDCARD, None)
+    # Returned by decodeBuffered for a value running past the end of the buffer
+    INCOMPLETE = (None, 'incomplete')
+
+    @classmethod
+    def buildProjection(cls, paths):
+        """Merge paths into a tree of {name, index or EACH: subtree}, where True keeps the whole value"""
+        root = {}
+        for segments in paths:
+            root = cls.merge(root, cls.project(segments))
+        return root
+
+    @classmethod
+    def project(cls, segments):
+        if not segments:
+            return True
+        kind, arg = segments[0]
+        rest = cls.project(segments[1:])
+        if kind == JsonPath.WILDCARD:
+            return {cls.EACH: rest}
+        if kind == JsonPath.SELECT:
+            # Every element keeps the field it is selected by, and what the rest of the path wants of it
+            return {cls.EACH: cls.merge(cls.project(arg[0].segments), rest)}
+        return {arg: rest}
+
+    @classmethod
+    def merge(cls, a, b):
+        if a is True or b is True:
+            return True
+        merged = dict(a)
+        for key, sub in b.items():
+            merged[key] = cls.merge(merged[key], sub) if key in merged else sub
+        return merged
+
+    @classmethod
+    def countLeaves(cls, projection):
+        """Count the subtrees to see before the rest of the document can be skipped, a whole EACH container being one"""
+        if projection is True or cls.EACH in projection:
+            return 1
+        return sum(cls.countLeaves(sub) for sub in projection.values())
+
+    def parse(self):
+        try:
+            if self.projection is True:
+                body = self.stream.read()
+                self.size = len(body)
+                return loadJson(body, self.backend)
+            return self.parseNode(self.projection)
+        finally:
+            self.stream.close()
+
+    @property
+    def done(self):
+        return len(self.satisfied) == self.leaves
+
+    def fill(self, size):
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.stream.read(size)
+        self.size += len(chunk)
+        if not chunk:
+            self.eof = True
+        self.buf += self.text_decoder.decode(chunk, final=self.eof)
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end of the document"""
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill(self.chunk_size)
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError("Expecting '%s' delimiter" % char, self.buf, self.pos)
+        self.pos += 1
+
+    def decodeValue(self):
+        """Decode the next complete value, reading more of the stream until it fits in the buffer"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer, or cut short by it as in "12.", may continue in the next chunk
+                if self.eof or (end < len(self.buf) and self.buf[end] not in self.number_chars):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow geometrically so a large value is not re-decoded once per chunk
+            self.fill(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def decodeBuffered(self):
+        """Decode the next value if the buffer holds all of it, else return INCOMPLETE without moving past it"""
+        self.peek()
+        try:
+            value, end = self.decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            return self.INCOMPLETE
+        if not self.eof and (end >= len(self.buf) or self.buf[end] in self.number_chars):
+            return self.INCOMPLETE
+        self.pos = end
+        return value
+
+    def skipValue(self):
+        """Move past the next value, decoding it at C speed if the buffer holds all of it and walking into it if not"""
+        char = self.peek()
+        if char not in ('{', '['):
+            self.decodeValue()
+            return
+        if self.decodeBuffered() is not self.INCOMPLETE:
+            return
+        self.pos += 1
+        closer = '}' if char == '{' else ']'
+        first = True
+        while True:
+            if self.peek() == closer:
+                self.pos += 1
+                return
+            if not first:
+                self.expect(',')
+            if closer == '}':
+                self.expect('"')
+                self.decodeKey()
+                self.expect(':')
+            self.skipValue()
+            first = False
+
+    @classmethod
+    def prune(cls, value, projection):
+        """Keep of a decoded value what projection wants, as parseNode would have"""
+        if projection is True or not isinstance(value, (dict, list)):
+            return value
+        each = projection.get(cls.EACH)
+        if each is None:
+            if isinstance(value, dict):
+                return dict((key, cls.prune(value[key], sub)) for key, sub in projection.items() if key in value)
+            result = [None] * len(value)
+            for index, sub in projection.items():
+                if isinstance(index, int) and 0 <= index < len(value):
+                    result[index] = cls.prune(value[index], sub)
+            return result
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        pruned = [(key, cls.prune(item, each if key not in projection else cls.merge(projection[key], each))) for key, item in items]
+        return dict(pruned) if isinstance(value, dict) else [item for _, item in pruned]
+
+    def parseNode(self, projection, counted=True):
+        """Parse the next value keeping what projection wants of it, counting its leaves as seen when counted"""
+        char = self.peek()
+        if char not in ('{', '['):
+            return self.decodeValue()
+        self.pos += 1
+        if char == '{':
+            result, closer = {}, '}'
+        else:
+            result, closer = [], ']'
+        each = projection.get(self.EACH)
+        index = 0
+        while not self.done:
+            char = self.peek()
+            if char == closer:
+                self.pos += 1
+                if each is not None and counted:
+                    self.satisfied.add((id(projection), self.EACH))
+                break
+            if index:
+                self.expect(',')
+            if closer == '}':
+                self.expect('"')
+                key = self.decodeKey()
+                self.expect(':')
+            else:
+                key = index
+            sub = projection.get(key)
+            if each is not None:
+                sub = each if sub is None else self.merge(sub, each)
+            if sub is None:
+                self.skipValue()
+                value = None
+            elif sub is True:
+                value = self.decodeValue()
+                if counted and each is None:
+                    self.satisfied.add((id(projection), key))
+            else:
+                # An element of (*) or a selector is decoded whole at C speed when the buffer holds it, then cut down
+                value = self.decodeBuffered() if each is not None else self.INCOMPLETE
+                if value is self.INCOMPLETE:
+                    value = self.parseNode(sub, counted and each is None)
+                else:
+                    value = self.prune(value, sub)
+            if closer == '}':
+                if sub is not None:
+                    result[key] = value
+            else:
+                result.append(value)
+            index += 1
+        return result
+
+    def decodeKey(self):
+        while True:
+            try:
+                key, end = json.decoder.scanstring(self.buf, self.pos)
+                self.pos = end
+                return key
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(self.chunk_size)
+
+class RunningAggregate:
+    """count, count=value1:value2, sum, min, max or avg of values added one at a time, like #function over (*)"""
+    def __init__(self, function):
+        self.function = function
+        self.values = frozenset(function[len('count='):].split(':')) if function.startswith('count=') else None
+        self.count = 0
+        self.numbers = 0
+        self.total = 0
+        self.low = self.high = None
+
+    def add(self, value):
+        if self.values is not None:
+            if str(value) in self.values:
+                self.count += 1
+            return
+        self.count += 1
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return
+        self.numbers += 1
+        self.total += number
+        if self.low is None or number < self.low:
+            self.low = number
+        if self.high is None or number > self.high:
+            self.high = number
+
+    def result(self):
+        if self.values is not None or self.function == 'count':
+            return self.count
+        if self.function == 'sum':
+            result = self.total
+        elif not self.numbers:
+            return NOT_FOUND
+        elif self.function == 'min':
+            result = self.low
+        elif self.function == 'max':
+            result = self.high
+        else:
+            result = self.total / self.numbers
+        if isinstance(result, float) and result.is_integer():
+            result = int(result)
+        return result
+
+class RecordAggregates:
+    """Newline delimited JSON records folded into one running aggregate per (*).path#function rule key"""
+    functions = r'^(count(=.*)?|sum|min|max|avg)$'
+    chunk_size = 64 * 1024
+
+    def __init__(self, keys, separator, backend=None):
+        self.backend = backend
+        self.lines = 0
+        self.size = 0
+        self.aggregates = {}
+        for key in keys:
+            path = JsonPath.compile(key, separator)
+            if path.segments[:1] != [(JsonPath.WILDCARD, None)] or not re.match(self.functions, path.aggregate or ''):
+                raise ValueError("key %s does not reduce the records, use (*)%skey#function with count, count=value, sum, min, max or avg"
+                                 % (key, separator))
+            self.aggregates[key] = (path, RunningAggregate(path.aggregate))
+        # Keys naming plain fields of the records are resolved inline, the rest are walked like a document
+        self.folds = []
+        for path, aggregate in self.aggregates.values():
+            names = [arg for kind, arg in path.segments[1:] if kind == JsonPath.NAME]
+            self.folds.append((path, names if len(names) == len(path.segments) - 1 else None, aggregate))
+
+    def feed(self, stream):
+        """Fold every record read from the file like stream into the aggregates, returning self"""
+        pending = []
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            self.size += len(chunk)
+            if b'\n' not in chunk:
+                pending.append(chunk)
+                continue
+            lines = chunk.split(b'\n')
+            lines[0] = b''.join(pending) + lines[0]
+            pending = [lines.pop()]
+            for line in lines:
+                self.fold(line)
+        self.fold(b''.join(pending))
+        return self
+
+    def fold(self, line):
+        self.lines += 1
+        if not line.strip():
+            return
+        try:
+            record = loadJson(line, self.backend, self.size)
+        except ValueError as e:
+            raise ValueError("line %d: %s" % (self.lines, e))
+        for path, names, aggregate in self.folds:
+            if names is not None:
+                value = record
+                for name in names:
+                    if not isinstance(value, dict) or name not in value:
+                        value = NOT_FOUND
+                        break
+                    value = value[name]
+            else:
+                value = path.walk(record, 1, None)
+            if isinstance(value, Matches):
+                for _, v in value:
+                    aggregate.add(v)
+            elif value != NOT_FOUND:
+                aggregate.add(value)
+
+    def get(self, key):
+        entry = self.aggregates.get(key)
+        return entry[1].result() if entry is not None else NOT_FOUND
+
+    def __repr__(self):
+        return repr(dict((key, self.get(key)) for key in self.aggregates))
+
+def _parseRange(r):
+    """Split a Nagios range [@]start:end into (invert, start, end), where start may be '~' and end 'infinity'"""
+    invert = False
+    start = 0
+    end = 'infinity'
+    if r.startswith('@'):
+        invert = True
+        r = r[1:]
+    vals = r.split(':')
+    if len(vals) == 1:
+        end = vals[0]
+    if len(vals) == 2:
+        start = vals[0]
+        if vals[1] != '':
+            end = vals[1]
+    return invert, start, end
+
+class Range:
+    """A Nagios [@]start:end range with its bounds parsed and converted to float once"""
+    def __init__(self, r, field_type):
+        self.text = r
+        self.invert, self.start, self.end = _parseRange(r)
+        self.low = float('-inf') if self.start == '~' else float(self.start)
+        self.high = float('inf') if self.end == 'infinity' else float(self.end)
+        self.start_text = self.typed(self.start, field_type)
+        self.end_text = self.typed(self.end, field_type)
+
+    @staticmethod
+    def typed(bound, field_type):
+        try:
+            return TypeHelper(bound, field_type)
+        except ValueError:
+            return str(bound)
+
+    def violates(self, number):
+        if self.invert:
+            return self.low <= number <= self.high
+        return number < self.low or number > self.high
+
+    def distance(self, number):
+        """How far number lies inside the failing part of the range, used to rank violators"""
+        if self.invert:
+            return min(number - self.low, self.high - number)
+        return max(self.low - number, number - self.high)
+
+    def failure(self, alias, key_val):
+        if self.start == '~':
+            if self.invert:
+                return " Value for key %s (%s) was less than or equal to %s." % (alias, key_val, self.end_text)
+            return " Value for key %s (%s) was greater than %s." % (alias, key_val, self.end_text)
+        if self.end == 'infinity':
+            if self.invert:
+                return " Value for key %s (%s) was greater than or equal to %s." % (alias, key_val, self.start_text)
+            return " Value for key %s (%s) was less than %s." % (alias, key_val, self.start_text)
+        if self.invert:
+            return " Value for key %s (%s) was inside the range '%s : %s'." % (alias, key_val, self.start_text, self.end_text)
+        return " Value for key %s (%s) was outside the range '%s : %s'." % (alias, key_val, self.start_text, self.end_text)
+
+    def bounds(self):
+        if self.start == '~':
+            return "':%s'" % self.end_text
+        if self.end == 'infinity':
+            return "'%s:'" % self.start_text
+        return "'%s : %s'" % (self.start_text, self.end_text)
+
+    def success(self, alias, key_val):
+        invert_str = ''
+        if self.invert: invert_str = 'not'
+        return " Value for key %s (%s) was%s in range %s." % (alias, key_val, invert_str, self.bounds())
+
+    def check(self, alias, value, number, program):
+        """Return (failure, success) where success is only formatted when called"""
+        if isinstance(value, Matches):
+            return self.checkMatches(alias, value, program)
+        if number is not None and self.violates(number):
+            return (self.failure(alias, program.typed(value)), None)
+        return ('', lambda: self.success(alias, program.typed(value)))
+
+    def checkMatches(self, alias, matches, program):
+        """Check every matched value, reporting only the top_violators furthest outside the range"""
+        violators = [(self.distance(number), labels, value) for number, labels, value in matches.numbers() if self.violates(number)]
+        if not violators:
+            return ('', lambda: " Values for key %s (%d) were %sin range %s." % (alias, len(matches), 'not ' if self.invert else '', self.bounds()))
+        violators.sort(key=lambda violator: violator[0], reverse=True)
+        top = program.top_violators
+        failure = ''.join(self.failure(Matches.label(alias, labels), program.typed(value)) for _, labels, value in violators[:top])
+        if len(violators) > top:
+            failure += " %d more values for key %s were %s the range %s." % (len(violators) - top, alias, 'inside' if self.invert else 'outside', self.bounds())
+        return (failure, None)
+
+class ThresholdRule:
+    """key[>alias],[@]start:end"""
+    numeric = True
+    converted = True
+
+    def __init__(self, key, alias, r, field_type):
+        self.key, self.alias = key, alias
+        self.range = Range(r, field_type)
+
+    @classmethod
+    def parse(cls, threshold, field_type):
+        k, r = threshold.split(',')
+        return cls(*_getKeyAlias(k), r, field_type)
+
+    def check(self, value, number, program):
+        return self.range.check(self.alias, value, number, program)
+
+class EqualityRule:
+    """key[>alias],value1:value2"""
+    numeric = False
+    converted = True
+
+    def __init__(self, key, alias, values):
+        self.key, self.alias = key, alias
+        self.text = ':'.join(values)
+        self.values = frozenset(values)
+
+    @classmethod
+    def parse(cls, kv):
+        k, text = kv.split(',')
+        return cls(*_getKeyAlias(k), text.split(':'))
+
+    def check(self, value, number, program):
+        if isinstance(value, Matches):
+            return self.checkMatches(value, program)
+        if value == NOT_FOUND or str(value) not in self.values:
+            return (" Value for key %s (%s) did not match %s." % (self.alias, program.typed(value), self.text), None)
+        return ('', lambda: " Value for key %s (%s) does match %s." % (self.alias, program.typed(value), self.text))
+
+    def checkMatches(self, matches, program):
+        """Check every matched value, reporting only the first top_violators that do not match"""
+        violators = [(labels, value) for labels, value in matches if str(value) not in self.values]
+        if not violators:
+            return ('', lambda: " Values for key %s (%d) do match %s." % (self.alias, len(matches), self.text))
+        top = program.top_violators
+        failure = ''.join(" Value for key %s (%s) did not match %s." % (Matches.label(self.alias, labels), program.typed(value), self.text)
+                          for labels, value in violators[:top])
+        if len(violators) > top:
+            failure += " %d more values for key %s did not match %s." % (len(violators) - top, self.alias, self.text)
+        return (failure, None)
+
+class ExistsRule:
+    """key[>alias]"""
+    numeric = False
+    # A #rate or #delta key exists when its counter does, even on the first check that has no rate yet
+    converted = False
+
+    def __init__(self, key, alias):
+        self.key, self.alias = key, alias
+
+    @classmethod
+    def parse(cls, k):
+        return cls(*_getKeyAlias(k))
+
+    def check(self, value, number, program):
+        if value == NOT_FOUND:
+            return (" Key %s did not exist." % self.alias, None)
+        return ('', None)
+
+class MetricRule:
+    """key[>alias],UnitOfMeasure,WarnRange,CriticalRange,Min,Max with the perfdata suffix rendered once"""
+    converted = True
+
+    def __init__(self, key, alias, uom, warn_range, crit_range, minimum, maximum, field_type):
+        self.key, self.alias = key, alias
+        bounds = [warn_range, crit_range, minimum, maximum]
+        while bounds and bounds[-1] is None:
+            bounds.pop()
+        self.suffix = uom + ''.join(";%s" % (bound if bound is not None else '') for bound in bounds)
+        self.ranges = []
+        for level, bound, r in ((WARNING_CODE, warn_range, warn_range), (CRITICAL_CODE, crit_range, crit_range),
+                                (CRITICAL_CODE, minimum, (minimum or '') + ':'), (CRITICAL_CODE, maximum, '~:' + (maximum or ''))):
+            if bound:
+                self.ranges.append((level, Range(r, field_type)))
+        self.numeric = bool(self.ranges)
+
+    @classmethod
+    def parse(cls, metric, field_type):
+        key = metric
+        minimum = maximum = warn_range = crit_range = None
+        uom = ''
+        if ',' in metric:
+            vals = metric.split(',')
+            if len(vals) == 2:
+                key, uom = vals
+            if len(vals) == 4:
+                key, uom, warn_range, crit_range = vals
+            if len(vals) == 6:
+                key, uom, warn_range, crit_range, minimum, maximum = vals
+        return cls(*_getKeyAlias(key), uom, warn_range, crit_range, minimum, maximum, field_type)
+
+    def check(self, value, number, program):
+        """Return (perfdata, warning, critical)"""
+        if value == NOT_FOUND:
+            return (' ', '', '')
+        warning = critical = ''
+        for level, r in self.ranges:
+            failure = r.check(self.alias, value, number, program)[0]
+            if level == WARNING_CODE:
+                warning += failure
+            else:
+                critical += failure
+        if isinstance(value, Matches):
+            # One perfdata entry per matched value
+            metrics = ' '.join("%s=%s%s" % (NagiosHelper.label(Matches.label(self.alias, labels)), v, self.suffix) for labels, v in value)
+        else:
+            metrics = "%s=%s%s" % (NagiosHelper.label(self.alias), value, self.suffix)
+        return (metrics + ' ', warning, critical)
+
+class RuleProgram:
+    """Rule arguments compiled once into typed rules grouped by key, shared by identical rule sets"""
+    _compiled = {}
+    file_fields = frozenset(['alias', 'warning', 'critical', 'equals', 'equals_critical', 'exists', 'exists_critical', 'metric'])
+    metric_fields = frozenset(['uom', 'warning', 'critical', 'min', 'max'])
+
+    @classmethod
+    def fromArgs(cls, rules):
+        signature = tuple(tuple(rule_list or ()) for rule_list in (
+            rules.key_threshold_warning, rules.key_value_list, rules.key_list,
+            rules.key_threshold_critical, rules.key_value_list_critical, rules.key_list_critical,
+            rules.metric_list)) + (rules.field_type, getattr(rules, 'top_violators', 5))
+        rules_file = getattr(rules, 'rules_file', None)
+        state = None
+        if rules_file:
+            st = os.stat(rules_file)
+            signature += (os.path.abspath(rules_file),)
+            state = (st.st_mtime_ns, st.st_size)
+        # A changed rules file replaces the program compiled from its previous version
+        cached_state, program = cls._compiled.get(signature, (None, None))
+        if program is None or cached_state != state:
+            program = cls.compileArgs(rules)
+            if rules_file:
+                program = program.merge(cls.load(rules_file, rules.field_type, getattr(rules, 'top_violators', 5), getattr(rules, 'cache_dir', None)))
+            remember(cls._compiled, signature, (state, program))
+        return program
+
+    @classmethod
+    def compileArgs(cls, rules):
+        warning = cls.compileLevel(rules.key_threshold_warning, rules.key_value_list, rules.key_list, rules.field_type)
+        critical = cls.compileLevel(rules.key_threshold_critical, rules.key_value_list_critical, rules.key_list_critical, rules.field_type)
+        metrics = [MetricRule.parse(metric, rules.field_type) for metric in rules.metric_list or []]
+        return cls(rules.field_type, getattr(rules, 'top_violators', 5), warning, critical, metrics)
+
+    @staticmethod
+    def compileLevel(thresholds, equalities, exists, field_type):
+        return ([ThresholdRule.parse(threshold, field_type) for threshold in thresholds or []] +
+                [EqualityRule.parse(kv) for kv in equalities or []] +
+                [ExistsRule.parse(k) for k in exists or []])
+
+    @classmethod
+    def compileFile(cls, path, field_type, top_violators):
+        """Compile a rules file, a JSON object of {key: {field: rule}} with the fields in file_fields"""
+        with open(path, 'rb') as f:
+            document = loadJson(f.read())
+        if not isinstance(document, dict):
+            raise ValueError("%s is not an object of key: rules" % path)
+        levels = {'warning': ([], [], []), 'critical': ([], [], [])}
+        metrics = []
+        for key, spec in document.items():
+            if not isinstance(spec, dict) or set(spec) - cls.file_fields:
+                raise ValueError("Rules for key %s must be an object of %s" % (key, ', '.join(sorted(cls.file_fields))))
+            alias = str(spec.get('alias', key))
+            for level, suffix in (('warning', ''), ('critical', '_critical')):
+                thresholds, equalities, exists = levels[level]
+                if spec.get(level) is not None:
+                    thresholds.append(ThresholdRule(key, alias, str(spec[level]), field_type))
+                values = spec.get('equals' + suffix)
+                if values is not None:
+                    values = values if isinstance(values, list) else [values]
+                    equalities.append(EqualityRule(key, alias, [str(value) for value in values]))
+                if spec.get('exists' + suffix):
+                    exists.append(ExistsRule(key, alias))
+            metric = spec.get('metric')
+            if metric is True:
+                metric = {}
+            if isinstance(metric, dict) and not set(metric) - cls.metric_fields:
+                bounds = [str(metric[field]) if metric.get(field) is not None else None for field in ('warning', 'critical', 'min', 'max')]
+                metrics.append(MetricRule(key, alias, str(metric.get('uom', '')), *bounds, field_type))
+            elif metric not in (None, False):
+                raise ValueError("Metric for key %s must be true or an object of %s" % (key, ', '.join(sorted(cls.metric_fields))))
+        return cls(field_type, top_violators, sum(levels['warning'], []), sum(levels['critical'], []), metrics)
+
+    @classmethod
+    def load(cls, path, field_type, top_violators, cache_dir=None):
+        """Return the compiled rules file at path, cached on disk by file path, mtime and size"""
+        import hashlib, pickle, tempfile
+        st = os.stat(path)
+        signature = '\0'.join(str(part) for part in (os.path.abspath(path), st.st_mtime_ns, st.st_size, field_type, top_violators,
+                                                     os.stat(__file__).st_mtime_ns, sys.version))
+        directory = cacheDirectory(cache_dir)
+        cache_path = os.path.join(directory, hashlib.sha256(signature.encode()).hexdigest() + '.rules')
+        try:
+            with open(cache_path, 'rb') as f:
+                if _trusted(os.fstat(f.fileno())):
+                    return pickle.load(f)
+        except Exception:
+            pass
+        program = cls.compileFile(path, field_type, top_violators)
+        try:
+            makeCacheDirectory(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(program, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, cache_path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except (OSError, pickle.PicklingError, AttributeError, TypeError):
+            # Caching is an optimization only, e.g. the plugin loaded under another module name cannot be pickled
+            pass
+        return program
+
+    def __init__(self, field_type, top_violators, warning, critical, metrics):
+        self.field_type = field_type
+        self.top_violators = top_violators
+        self.warning = warning
+        self.critical = critical
+        self.metrics = metrics
+        self.keys = {}
+        for rule in self.warning + self.critical + self.metrics:
+            self.keys.setdefault(rule.key, []).append(rule)
+        self.numeric_keys = set(key for key, key_rules in self.keys.items() if any(rule.numeric for rule in key_rules))
+        self.counters = dict((key, JsonPath.splitCounter(key)) for key in self.keys if JsonPath.splitCounter(key)[1])
+
+    def merge(self, other):
+        """Return a program running the rules of both programs, these first"""
+        return RuleProgram(self.field_type, self.top_violators,
+                           self.warning + other.warning, self.critical + other.critical, self.metrics + other.metrics)
+
+    def typed(self, value):
+        return TypeHelper(value, self.field_type)
+
+    def number(self, key, value):
+        if key in self.numeric_keys and value != NOT_FOUND and not isinstance(value, Matches):
+            return float(value)
+        return None
+
+    def evaluate(self, helper, counters=None, trace=None):
+        """Resolve every distinct key once and run all of its rules, returning {rule: result}"""
+        results = {}
+        for key, key_rules in self.keys.items():
+            if trace is not None:
+                trace.resolving(helper)
+            value = raw = helper.get(key)
+            if counters is not None and key in self.counters:
+                value = counters.convert(*self.counters[key], value)
+            number = self.number(key, value)
+            if trace is None:
+                for rule in key_rules:
+                    results[rule] = rule.check(value, number, self) if rule.converted else rule.check(raw, None, self)
+            else:
+                trace.resolved(helper, key, raw, value, number)
+                for rule in key_rules:
+                    results[rule] = trace.check(rule, value, number, self) if rule.converted else trace.check(rule, raw, None, self)
+                trace.checked(value)
+        return results
+
+    @staticmethod
+    def parts(rules, results):
+        """Return the failures of rules and their success messages, still unformatted callables"""
+        return ([results[rule][0] for rule in rules], [results[rule][1] for rule in rules if results[rule][1] is not None])
+
+    @staticmethod
+    def render(rules, results):
+        """Join the (failure, success) results of rules, formatting the success messages now"""
+        failure = ''.join(results[rule][0] for rule in rules)
+        success = ''.join(results[rule][1]() for rule in rules if results[rule][1] is not None)
+        return (failure, success)
+
+class EngineTrace:
+    """Time spent per key and rule by one rule evaluation, for --trace"""
+    aggregates = frozenset(['sum', 'min', 'max', 'avg'])
+
+    def __init__(self, program):
+        self.levels = {}
+        for level, rules in (('warning', program.warning), ('critical', program.critical), ('metric', program.metrics)):
+            for rule in rules:
+                self.levels[rule] = level
+        self.keys = []
+
+    def resolving(self, helper):
+        """Start timing the resolution of the next key"""
+        self.walks = getattr(helper, 'walks', 0)
+        self.started = time.perf_counter()
+
+    def resolved(self, helper, key, raw, value, number):
+        """Record the key resolved since resolving()"""
+        resolved = time.perf_counter()
+        entry = {'key': key, 'resolve_ms': round((resolved - self.started) * 1000, 3), 'walks': getattr(helper, 'walks', 0) - self.walks}
+        entry['matches'], entry['floats'] = self.conversions(helper, key, raw, value, number, entry['walks'])
+        entry['rules'] = []
+        self.keys.append(entry)
+
+    def check(self, rule, value, number, program):
+        """Run rule against the last resolved key, timing the check and the formatting of its success message"""
+        clock = time.perf_counter
+        started = clock()
+        result = rule.check(value, number, program)
+        checked = clock()
+        if len(result) == 2 and result[1] is not None:
+            # Success messages are formatted on output, format this one now to time it
+            message = result[1]()
+            result = (result[0], lambda message=message: message)
+        self.keys[-1]['rules'].append({'level': self.levels.get(rule), 'rule': type(rule).__name__, 'alias': rule.alias,
+                                       'check_ms': round((checked - started) * 1000, 3), 'format_ms': round((clock() - checked) * 1000, 3)})
+        return result
+
+    def checked(self, value):
+        """Count the values of a (*) key its rules converted to float"""
+        if isinstance(value, Matches) and value._numbers is not None:
+            self.keys[-1]['floats'] += len(value)
+
+    def conversions(self, helper, key, raw, value, number, walks):
+        """Return how many values key matched and how many were converted to float to resolve it"""
+        matches = len(raw) if isinstance(raw, Matches) else int(raw != NOT_FOUND)
+        floats = int(number is not None)
+        if value is not raw:
+            floats += matches
+        path = JsonPath.compile(key, helper.separator) if isinstance(helper, JsonHelper) else None
+        if walks and path is not None and path.base in helper.reduced:
+            matches = helper.reduced[path.base]
+            if path.aggregate in self.aggregates or path.aggregate.startswith('p'):
+                floats += matches
+        return matches, floats
+
+    def report(self, target, timings):
+        """Return the trace as a dict, with the totals over every key and the phases of the check so far"""
+        rules = [rule for entry in self.keys for rule in entry['rules']]
+        totals = {'keys': len(self.keys), 'rules': len(rules)}
+        for field in ('resolve_ms', 'walks', 'matches', 'floats'):
+            totals[field] = round(sum(entry[field] for entry in self.keys), 3)
+        for field in ('check_ms', 'format_ms'):
+            totals[field] = round(sum(rule[field] for rule in rules), 3)
+        phases = dict((phase, round(duration * 1000, 3)) for phase, duration in timings.durations.items())
+        return {'target': target, 'size': timings.size, 'phases': phases, 'totals': totals, 'keys': self.keys}
+
+    @staticmethod
+    def write(report, destination):
+        """Write report as one compact JSON line to stderr for "-", or append it to the file destination"""
+        line = json.dumps(report, separators=(',', ':'), default=str) + '\n'
+        if destination == '-':
+            sys.stderr.write(line)
+        else:
+            with open(destination, 'a') as f:
+                f.write(line)
+
+class JsonRuleProcessor:
+    """Perform checks and gather values from a JSON dict given rules and metrics definitions"""
+    def __init__(self, json_data, rules_args, counters=None, trace=None):
+        self.data = json_data
+        self.rules = rules_args
+        self.counters = counters
+        self.trace = trace
+        separator = '.'
+        if self.rules.separator: separator = self.rules.separator
+        # With --ndjson the records arrive reduced to the value of every key
+        self.helper = json_data if getattr(rules_args, 'ndjson', False) else JsonHelper(self.data, separator)
+        self.program = RuleProgram.fromArgs(rules_args)
+        self.results = None
+        debugPrint(rules_args.debug, "rules:%s" % rules_args)
+        debugPrint(rules_args.debug, "separator:%s" % separator)
+
+    def evaluate(self):
+        """Run the whole rule program in one pass over its keys, the check* methods then only pick their results"""
+        if self.results is None:
+            self.results = self.program.evaluate(self.helper, self.counters, self.trace)
+        return self.results
+
+    def checkRules(self, rules):
+        results = {}
+        for rule in rules:
+            value = self.helper.get(rule.key)
+            number = float(value) if rule.numeric and value != NOT_FOUND and not isinstance(value, Matches) else None
+            results[rule] = rule.check(value, number, self.program)
+        return self.program.render(rules, results)
+
+    def checkThreshold(self, key, alias, r):
+        value = self.helper.get(key)
+        number = float(value) if value != NOT_FOUND and not isinstance(value, Matches) else None
+        failure, success = Range(r, self.rules.field_type).check(alias, value, number, self.program)
+        return (failure, success() if success is not None else '')
+
+    def checkExists(self, exists_list):
+        return self.checkRules([ExistsRule.parse(k) for k in exists_list])
+
+    def checkEquality(self, equality_list):
+        return self.checkRules([EqualityRule.parse(kv) for kv in equality_list])
+
+    def checkThresholds(self, threshold_list):
+        return self.checkRules([ThresholdRule.parse(threshold, self.rules.field_type) for threshold in threshold_list])
+
+    def checkWarning(self):
+        return self.program.render(self.program.warning, self.evaluate())
+
+    def checkCritical(self):
+        return self.program.render(self.program.critical, self.evaluate())
+
+    def report(self, nagios):
+        """Append the result of every rule to nagios as separate parts, which it renders within its output budget"""
+        results = self.evaluate()
+        nagios.append_warning(*self.program.parts(self.program.warning, results))
+        nagios.append_critical(*self.program.parts(self.program.critical, results))
+        metrics = [results[rule] for rule in self.program.metrics]
+        nagios.append_metrics([result[0] for result in metrics], [result[1] for result in metrics], [result[2] for result in metrics])
+
+    def checkMetrics(self):
+        """Return a Nagios specific performance metrics string given keys and parameter definitions"""
+        results = self.evaluate()
+        metrics = ''.join(results[rule][0] for rule in self.program.metrics)
+        warning = ''.join(results[rule][1] for rule in self.program.metrics)
+        critical = ''.join(results[rule][2] for rule in self.program.metrics)
+        return ["%s" % metrics, warning, critical]
+
+def parseArgs(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=
+        'Nagios plugin which checks json values from a given endpoint against argument specified rules\
+        and determines the status and performance data for that service\n' + """
+Examples:
+
+    ./check_http_json.py --host localhost --port 8088 --path jmx --warning "beans.(0).val,10:20"
+
+Will test if the json at http://localhost:8088/jmx has an element like  {beans:[{val: 15}]}  
+
+If you can't be sure of the location in the json of some value, you can search using (name=value), but this is somewhat limited, so the value part has to be base64 encoded.
+E.g. if you want to find the element in a list where "name" is equal to "java.lang:type=MemoryPool (raw),name=Metaspace" you have to encode the value part to:
+
+python -c "import base64; print(base64.b64encode('java.lang:type=MemoryPool (raw),name=Metaspace'))" and get "amF2YS5sYW5nOnR5cGU9TWVtb3J5UG9vbCAocmF3KSxuYW1lPU1ldGFzcGFjZQ==".
+You can now query a unknown json tree using:
+
+    ./chech_http_json.py --host localhost --port 8088 --part jmx --warning "beans.(name=amF2YS5sYW5nOnR5cGU9TWVtb3J5UG9vbCAocmF3KSxuYW1lPU1ldGFzcGFjZQ==).someProp,RANGE"
+""")
+
+    # parser.add_argument('-v', '--verbose', action='store_true', help='Verbose Output')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debug mode, printing the parts of the document the rules refer to.')
+    parser.add_argument('-s', '--ssl', action='store_true', help='HTTPS mode.')
+    parser.add_argument('-H', '--host', dest='host', action='append',
+        help='Host. Repeat or separate hosts with commas to check a cluster, every node is queried concurrently and -t applies per node.')
+    parser.add_argument('-i', '--input', dest='input', metavar='FILE',
+        help='Check the JSON document in this file, or stdin for "-", instead of fetching it. No HTTP modules are loaded.')
+    parser.add_argument('-P', '--port', dest='port', help='TCP port')
+    parser.add_argument('-U', '--unix-socket', dest='unix_socket', metavar='PATH',
+        help='Send the request over this Unix domain socket instead of TCP. -H then only sets the Host header and defaults to localhost.')
+    parser.add_argument('-p', '--path', dest='path', action='append',
+        help='Path. Repeat to check several documents of the same host in one go, rules then address each one as name.key \
+        where the name is given with path>name and defaults to the path.')
+    parser.add_argument('-t', '--timeout', type=int, help='Connection timeout (seconds)')
+    parser.add_argument('--quorum', type=int,
+        help='With several hosts, the cluster is OK when this many nodes are, otherwise it takes the state of the quorum-th \
+        best node. Defaults to every node.')
+    parser.add_argument('--aggregate', action='store_true',
+        help='With several hosts, check the rules once against {host: document} of the nodes that answered, addressing them as \
+        (*).key with an aggregate like #max, instead of per node. --quorum then counts the nodes that answered.')
+    parser.add_argument('--deadline', type=float,
+        help='Give up on the check with CRITICAL once it ran this many seconds, covering connect, headers, body and parse, \
+        unlike -t which limits each socket operation.')
+    parser.add_argument('--max-size', dest='max_size', type=int, default=64 * 1024 * 1024,
+        help='Give up with UNKNOWN on a response body of more than this many bytes as received, defaults to 64MiB, 0 disables it.')
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+        help='Do not ask for gzip or deflate compressed responses.')
+    parser.add_argument('--max-decoded-size', dest='max_decoded_size', type=int, default=256 * 1024 * 1024,
+        help='Give up on a compressed response once it decodes to more than this many bytes, defaults to 256MiB, 0 disables it.')
+    parser.add_argument('-B', '--basic-auth', dest='auth', help='Basic auth string "username:password"')
+    parser.add_argument('-D', '--data', dest='data', help='The http payload to send as a POST')
+    parser.add_argument('-A', '--headers', dest='headers', help='The http headers in JSON format.')
+    parser.add_argument('-f', '--field_separator', dest='separator',
+        help='Json Field separator, defaults to "." ; Select element in an array with "(" ")" ; Use "(" name = base64(val) ")" for finding keys matching a certain value.')
+    parser.add_argument('-ft', '--field_type', dest='field_type', help='Treat numbers as <type>, e.g. "str|size|SI".', default = 'str')
+    parser.add_argument('-w', '--warning', dest='key_threshold_warning', nargs='*',
+        help='Warning threshold for these values (key1[>alias],WarnRange key2[>alias],WarnRange). WarnRange is in the format [@]start:end, more information at nagios-plugins.org/doc/guidelines.html.')
+    parser.add_argument('-c', '--critical', dest='key_threshold_critical', nargs='*',
+        help='Critical threshold for these values (key1[>alias],CriticalRange key2[>alias],CriticalRange. CriticalRange is in the format [@]start:end, more information at nagios-plugins.org/doc/guidelines.html.')
+    parser.add_argument('-e', '--key_exists', dest='key_list', nargs='*',
+        help='Checks existence of these keys to determine status. Return warning if key is not present.')
+    parser.add_argument('-E', '--key_exists_critical', dest='key_list_critical', nargs='*',
+        help='Same as -e but return critical if key is not present.')
+    parser.add_argument('-q', '--key_equals', dest='key_value_list', nargs='*',
+        help='Checks equality of these keys and values (key[>alias],value key2,value2) to determine status.\
+        Multiple key values can be delimited with colon (key,value1:value2). Return warning if equality check fails')
+    parser.add_argument('-Q', '--key_equals_critical', dest='key_value_list_critical', nargs='*',
+        help='Same as -q but return critical if equality check fails.')
+    parser.add_argument('-m', '--key_metric', dest='metric_list', nargs='*',
+        help='Gathers the values of these keys (key[>alias],UnitOfMeasure,WarnRange,CriticalRange,Min,Max) for Nagios performance data.\
+        More information about Range format and units of measure for nagios can be found at nagios-plugins.org/doc/guidelines.html\
+        Additional formats for this parameter are: (key[>alias]), (key[>alias],UnitOfMeasure), (key[>alias],UnitOfMeasure,WarnRange,CriticalRange).')
+    parser.add_argument('-r', '--rules', dest='rules_file', metavar='FILE',
+        help='Also check the rules in this JSON file, an object of {key: {"alias", "warning", "critical", "equals", "equals_critical", \
+        "exists", "exists_critical", "metric"}}. Its compiled form is cached in --cache-dir by file path and modification time.')
+    parser.add_argument('--state-dir', dest='state_dir',
+        help='Directory keeping the previous values of key#rate and key#delta counters, one file per host, path and request, \
+        owned by the user running the checks. Defaults to check_http_json_state-<uid> in the temp directory.')
+    parser.add_argument('--state-ttl', dest='state_ttl', type=float, default=86400,
+        help='Forget counter values not updated for this many seconds, defaults to a day.')
+    parser.add_argument('--top-violators', dest='top_violators', type=int, default=5,
+        help='Only report this many of the values matched by a (*) key that violate a threshold, worst first. Defaults to 5.')
+    parser.add_argument('--json-backend', dest='json_backend', choices=JSON_BACKENDS,
+        help='Force this JSON decoder instead of the fastest one installed, trying %s in this order.' % ', '.join(JSON_BACKENDS))
+    parser.add_argument('-l', '--long-output', dest='long_output', action='store_true',
+        help='Use Nagios long output: problems on the first line, then one success detail and one performance data entry per line.')
+    parser.add_argument('--max-output', dest='max_output', type=int, default=0,
+        help='Keep the output within this many bytes, dropping success details first, then problems, so that the \
+        performance data is not cut off, e.g. 8192 for the Nagios plugin output limit. Defaults to 0, unlimited.')
+    parser.add_argument('--stream', action='store_true',
+        help='Parse the response while it is read, keeping only the subtrees the rules refer to and stopping once all of them were seen. \
+        (*) and (name=value) keep what the rule wants of every element, their arrays are read to the end.')
+    parser.add_argument('--ndjson', action='store_true',
+        help='The response is newline delimited JSON records, read one at a time. Rules address the records like the elements \
+        of an array, as (*).key#function with count, count=value, sum, min, max or avg, kept as running aggregates.')
+    parser.add_argument('--timings', action='store_true',
+        help='Add the time spent in DNS, connect, TLS, time to first byte, download, parse and rules, the total and the response size, \
+        decoded and as received, to the performance data.')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+        help='Write the cost of every rule key as one JSON line to stderr, or append it to FILE: the time to resolve the key, \
+        its document walks, matched values and float conversions, and the time to check each rule and format its message.')
+    parser.add_argument('--profile', metavar='FILE',
+        help='Profile the check with cProfile and write the statistics to FILE, to be read with python3 -m pstats FILE.')
+    parser.add_argument('--timings-warning', dest='timings_warning',
+        help='Warning range for the total check time in milliseconds, implies --timings.')
+    parser.add_argument('--timings-critical', dest='timings_critical',
+        help='Critical range for the total check time in milliseconds, implies --timings.')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', type=float,
+        help='Cache the response on disk for this many seconds, so checks of the same URL, data, headers and auth share one fetch.')
+    parser.add_argument('--cache-dir', dest='cache_dir', help='Response cache directory, owned by the user running the checks. Defaults to check_http_json_cache-<uid> in the temp directory.')
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=int, default=64 * 1024 * 1024,
+        help='Evict the oldest cached responses beyond this many bytes, defaults to 64MiB.')
+    parser.add_argument('--batch', dest='batch',
+        help='Run every check in this JSON manifest concurrently and print one Nagios passive check result per check.\
+        The manifest is a list of {"host_name": ..., "service_description": ..., "args": [...]} where args are the options of a single check.')
+    parser.add_argument('--daemon', dest='daemon', metavar='SOCKET',
+        help='Keep running and serve checks sent by check_http_json_client.py over this Unix socket.')
+    parser.add_argument('--batch-workers', dest='batch_workers', type=int, default=8,
+        help='Maximum number of checks run concurrently in batch mode, defaults to 8.')
+
+    args = parser.parse_args(argv)
+    args.hosts = [host for value in args.host or () for host in value.split(',') if host]
+    if args.unix_socket:
+        if args.ssl or len(args.hosts) > 1:
+            parser.error('argument -U/--unix-socket: not allowed with -s/--ssl or several hosts')
+        args.hosts = args.hosts or ['localhost']
+    args.host = args.hosts[0] if args.hosts else None
+    if args.top_violators < 1:
+        parser.error('argument --top-violators: must be at least 1')
+    if (args.quorum is not None or args.aggregate) and len(args.hosts) < 2:
+        parser.error('argument --%s: only allowed with several hosts' % ('quorum' if args.quorum is not None else 'aggregate'))
+    if args.quorum is not None and not 1 <= args.quorum <= len(args.hosts):
+        parser.error('argument --quorum: must be between 1 and the number of hosts')
+    if args.timings_warning or args.timings_critical:
+        args.timings = True
+    if args.json_backend:
+        try:
+            jsonDecoder(args.json_backend)
+        except ImportError:
+            parser.error('argument --json-backend: %s is not installed' % args.json_backend)
+    if args.ndjson and (args.aggregate or len(args.path or ()) > 1):
+        parser.error('argument --ndjson: not allowed with --aggregate or several paths')
+    if args.input and (args.host or args.path):
+        parser.error('argument -i/--input: not allowed with -H/--host, -p/--path or -U/--unix-socket')
+    if not args.host and not args.input and not args.batch and not args.daemon:
+        parser.error('the following arguments are required: -H/--host or -i/--input')
+    return args
+
+def debugPrint(debug_flag, message, pretty_flag=False):
+    if debug_flag:
+        # A daemon or batch check sets the flag to the file its debug output goes to
+        stream = debug_flag if hasattr(debug_flag, 'write') else None
+        if pretty_flag:
+            from pprint import pprint
+            pprint(message, stream=stream)
+        else:
+            print(message, file=stream)
+
+class PooledResponse:
+    """Response whose keep-alive connection goes back to its pool once the body has been read"""
+    def __init__(self, pool, key, conn, response, watchdog=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.watchdog = watchdog
+        self.status = response.status
+        self.headers = response.headers
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        chunk = self.response.read(amt)
+        if self.response.isclosed():
+            self.close()
+        return chunk
+
+    def read1(self, amt=-1):
+        chunk = self.response.read1(amt)
+        if self.response.isclosed():
+            self.close()
+        return chunk
+
+    def close(self):
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        if self.conn is not None:
+            self.pool.release(self.key, self.conn, self.response)
+            self.conn = None
+
+class DecodingError(Exception):
+    """A response body that cannot be decoded as its Content-Encoding says"""
+
+class ResponseTooLarge(Exception):
+    """A response body larger than --max-size as received"""
+
+class DeadlineExceeded(Exception):
+    """A check still running at its --deadline"""
+
+class Deadline:
+    """End-to-end time limit of one check, enforced by socket timeouts and a watchdog"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded("%gs" % self.seconds)
+
+    def timeout(self, timeout):
+        """Return the socket timeout for the next request, the smaller of timeout and the time left"""
+        self.check()
+        return self.remaining() if timeout is None else min(timeout, self.remaining())
+
+    def watch(self, connections):
+        """Start the watchdog timer of connections, which may still grow, to be cancelled once the response has been read"""
+        import socket, threading
+        def expire():
+            for conn in list(connections):
+                sock = conn.sock
+                if sock is not None:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+        watchdog = threading.Timer(max(self.remaining(), 0), expire)
+        watchdog.daemon = True
+        watchdog.start()
+        return watchdog
+
+    def urlopen(self, req, data=None, timeout=None):
+        """Open req with urllib, as redirects and proxies need, under the same watchdog as pooled connections"""
+        import urllib.request
+        connections = []
+
+        class Watched:
+            def do_open(self, http_class, req, **kwargs):
+                def connection(*args, **kwargs):
+                    conn = http_class(*args, **kwargs)
+                    connections.append(conn)
+                    return conn
+                return super().do_open(connection, req, **kwargs)
+
+        class WatchedHTTPHandler(Watched, urllib.request.HTTPHandler):
+            pass
+
+        class WatchedHTTPSHandler(Watched, urllib.request.HTTPSHandler):
+            pass
+
+        opener = urllib.request.build_opener(WatchedHTTPHandler, WatchedHTTPSHandler)
+        watchdog = self.watch(connections)
+        try:
+            response = opener.open(req, data=data, timeout=self.timeout(timeout))
+        except Exception:
+            watchdog.cancel()
+            # A socket shut down by the watchdog fails like any other
+            self.check()
+            raise
+        return WatchedResponse(response, watchdog)
+
+class WatchedResponse:
+    """urllib response whose deadline watchdog is cancelled once the body has been read"""
+    def __init__(self, response, watchdog):
+        self.response = response
+        self.watchdog = watchdog
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def close(self):
+        self.watchdog.cancel()
+        self.response.close()
+
+def lockFile(lock, deadline=None, timeout=None):
+    """Lock the open file lock exclusively, polling until the deadline or timeout runs out. Raises DeadlineExceeded"""
+    import fcntl
+    if timeout and (deadline is None or timeout < deadline.remaining()):
+        deadline = Deadline(timeout)
+    if deadline is None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if deadline.remaining() <= 0:
+                raise DeadlineExceeded("%gs, locked:%s" % (deadline.seconds, lock.name))
+            time.sleep(min(0.01, deadline.remaining()))
+
+class DecodedResponse:
+    """Response body reader inflating gzip and deflate as it reads, within the size and time limits"""
+    chunk_size = 64 * 1024
+
+    def __init__(self, response, timings, limit=None, max_size=None, deadline=None):
+        import zlib
+        self.zlib = zlib
+        self.response = response
+        self.timings = timings
+        self.limit = limit
+        self.max_size = max_size
+        self.deadline = deadline
+        self.decoded = 0
+        self.received = 0
+        length = response.headers.get('Content-Length')
+        if max_size and length and length.strip().isdigit() and int(length) > max_size:
+            response.close()
+            raise ResponseTooLarge("Content-Length %s exceeds %d bytes" % (length.strip(), max_size))
+        self.encoding = (response.headers.get('Content-Encoding') or 'identity').strip().lower()
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.inflater = zlib.decompressobj(zlib.MAX_WBITS)
+        elif self.encoding == 'identity':
+            self.inflater = None
+        else:
+            response.close()
+            raise DecodingError("unsupported Content-Encoding %s" % self.encoding)
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def receive(self, amt):
+        """Read up to amt bytes of the body as received, one recv() at a time with a deadline"""
+        if self.deadline is None:
+            chunk = self.response.read(amt)
+        else:
+            self.deadline.check()
+            try:
+                chunk = self.response.read1(amt)
+            except Exception:
+                self.deadline.check()
+                raise
+            if not chunk:
+                # A socket shut down by the watchdog reads as the end of the body
+                self.deadline.check()
+        self.received += len(chunk)
+        self.timings.wire += len(chunk)
+        if self.max_size and self.received > self.max_size:
+            raise ResponseTooLarge("body exceeds %d bytes" % self.max_size)
+        return chunk
+
+    def receiveAll(self):
+        chunks = []
+        chunk = self.receive(self.chunk_size)
+        while chunk:
+            chunks.append(chunk)
+            chunk = self.receive(self.chunk_size)
+        return b''.join(chunks)
+
+    def read(self, amt=None):
+        if self.inflater is None:
+            return self.receiveAll() if amt is None else self.receive(amt)
+        chunks = []
+        size = 0
+        while amt is None or size < amt:
+            data = self.inflater.unconsumed_tail
+            if not data:
+                if self.inflater.eof:
+                    # Drain the connection so that it can be reused
+                    self.receiveAll()
+                    break
+                data = self.receive(self.chunk_size)
+                if not data:
+                    chunks.append(self.inflater.flush())
+                    break
+            try:
+                # Bounding the output of each call keeps a highly compressed body from expanding all at once
+                chunk = self.inflater.decompress(data, self.chunk_size if amt is None else amt - size)
+            except self.zlib.error as e:
+                if self.encoding != 'deflate' or self.decoded or size:
+                    raise DecodingError("%s body: %s" % (self.encoding, e))
+                # Some servers send raw deflate data without the zlib header
+                self.inflater = self.zlib.decompressobj(-self.zlib.MAX_WBITS)
+                chunk = self.inflater.decompress(data, self.chunk_size if amt is None else amt - size)
+            chunks.append(chunk)
+            size += len(chunk)
+            if self.limit and self.decoded + size > self.limit:
+                raise DecodingError("decoded body exceeds %d bytes" % self.limit)
+        self.decoded += size
+        return b''.join(chunks)
+
+    def close(self):
+        self.response.close()
+
+class Timings:
+    """Per-phase durations of one check measured with a monotonic clock, reported as perfdata in milliseconds"""
+    phases = ('dns', 'connect', 'tls', 'ttfb', 'download', 'parse', 'rules')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.durations = {}
+        self.size = 0
+        self.wire = 0
+
+    def add(self, phase, started):
+        self.durations[phase] = self.durations.get(phase, 0) + time.monotonic() - started
+
+    def total(self):
+        return (time.monotonic() - self.started) * 1000
+
+    def perfdata(self, total, warning, critical):
+        metrics = ''.join("'%s'=%.3fms " % (phase, self.durations[phase] * 1000) for phase in self.phases if phase in self.durations)
+        metrics += "'total'=%.3fms" % total
+        if warning or critical:
+            metrics += ";%s;%s" % (warning or '', critical or '')
+        metrics += ' '
+        return metrics + "'size'=%dB 'wire_size'=%dB " % (self.size, self.wire)
+
+class TimedConnectionMixin:
+    """Connects like http.client, recording DNS and TCP connect time into the timings set on the connection"""
+    timings = None
+
+    def connect(self):
+        import socket
+        timings = self.timings if self.timings is not None else Timings()
+        started = time.monotonic()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        timings.add('dns', started)
+        started = time.monotonic()
+        error = None
+        for family, socktype, proto, _, address in addresses:
+            # Connect to the resolved address as is, it keeps the IPv6 flow info and scope id
+            sock = socket.socket(family, socktype, proto)
+            try:
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                if self.source_address:
+                    sock.bind(self.source_address)
+                sock.connect(address)
+                self.sock = sock
+                break
+            except OSError as e:
+                sock.close()
+                error = e
+        else:
+            raise error
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        timings.add('connect', started)
+
+TimedHTTPConnection = TimedHTTPSConnection = TimedUnixHTTPConnection = None
+
+def _timedConnection(scheme):
+    """Return the timed connection class for scheme, http, https or unix, defining them on first use"""
+    global TimedHTTPConnection, TimedHTTPSConnection, TimedUnixHTTPConnection
+    if TimedHTTPConnection is None:
+        import http.client
+
+        class TimedHTTPConnection(TimedConnectionMixin, http.client.HTTPConnection):
+            pass
+
+        class TimedHTTPSConnection(TimedConnectionMixin, http.client.HTTPSConnection):
+            def connect(self):
+                TimedConnectionMixin.connect(self)
+                started = time.monotonic()
+                self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+                if self.timings is not None:
+                    self.timings.add('tls', started)
+
+        class TimedUnixHTTPConnection(http.client.HTTPConnection):
+            """HTTP over the Unix domain socket at socket_path, recording the connect time"""
+            timings = None
+
+            def __init__(self, socket_path, port=None, timeout=None):
+                http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+                self.socket_path = socket_path
+
+            def connect(self):
+                import socket
+                started = time.monotonic()
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.settimeout(self.timeout)
+                    sock.connect(self.socket_path)
+                except OSError:
+                    sock.close()
+                    raise
+                self.sock = sock
+                if self.timings is not None:
+                    self.timings.add('connect', started)
+
+    if scheme == 'unix':
+        return TimedUnixHTTPConnection
+    return TimedHTTPSConnection if scheme == 'https' else TimedHTTPConnection
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) and Unix socket connections shared between checks, failing like urllib"""
+    def __init__(self):
+        import threading
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key, timeout):
+        import select
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                conn = idle.pop() if idle else None
+            if conn is None:
+                break
+            # An idle connection the server closed reads as readable, skip it before sending anything
+            if conn.sock is None or select.select([conn.sock], [], [], 0)[0]:
+                conn.close()
+                continue
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, host, port = key
+        return _timedConnection(scheme)(host, port, timeout=timeout), False
+
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def release(self, key, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    @staticmethod
+    def proxied(url):
+        """Whether urllib would send a request for url through a proxy set in the environment"""
+        from urllib.request import getproxies, proxy_bypass
+        return url.scheme in getproxies() and not proxy_bypass(url.hostname)
+
+    def urlopen(self, req, data=None, timeout=None, timings=None, deadline=None, unix_socket=None):
+        import http.client, urllib.parse, urllib.request
+        from urllib.error import HTTPError, URLError
+        from urllib.request import urlopen
+        url = urllib.parse.urlsplit(req.full_url)
+        try:
+            url.port
+        except ValueError as e:
+            # Fail like urllib does for the same URL
+            raise http.client.InvalidURL(e)
+        if not unix_socket and self.proxied(url):
+            if deadline is not None:
+                return deadline.urlopen(req, data, timeout)
+            return urlopen(req, data=data, timeout=timeout)
+        key = ('unix', unix_socket, None) if unix_socket else (url.scheme, url.hostname, url.port)
+        path = (url.path or '/') + ('?' + url.query if url.query else '')
+        headers = dict(req.header_items())
+        # Identify like urllib does, servers may answer other clients differently
+        headers.setdefault('User-agent', 'Python-urllib/%s' % urllib.request.__version__)
+        if unix_socket:
+            headers.setdefault('Host', url.netloc)
+        if data is not None:
+            headers.setdefault('Content-type', 'application/x-www-form-urlencoded')
+        watchdog = None
+        for attempt in range(2):
+            if deadline is not None:
+                timeout = deadline.timeout(timeout)
+            conn, reused = self.acquire(key, timeout)
+            conn.timings = timings
+            if deadline is not None:
+                watchdog = deadline.watch([conn])
+            try:
+                conn.request('POST' if data is not None else 'GET', path, body=data, headers=headers)
+                started = time.monotonic()
+                response = conn.getresponse()
+                if timings is not None:
+                    timings.add('ttfb', started)
+                break
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if watchdog is not None:
+                    watchdog.cancel()
+                    deadline.check()
+                # An idle keep-alive connection may have been closed by the server, retry once on a fresh one.
+                # A POST body may have reached the server already and is never sent twice
+                if not reused or attempt or data is not None:
+                    raise URLError(e)
+        if response.status >= 300 and watchdog is not None:
+            watchdog.cancel()
+        if 300 <= response.status < 400 and not unix_socket:
+            # Let urllib follow redirects, over TCP only
+            conn.close()
+            if deadline is not None:
+                return deadline.urlopen(req, data, timeout)
+            return urlopen(req, data=data, timeout=timeout)
+        if response.status >= 300:
+            conn.close()
+            raise HTTPError(req.full_url, response.status, response.reason, response.headers, None)
+        return PooledResponse(self, key, conn, response, watchdog)
+
+def cacheDirectory(cache_dir=None):
+    """Return cache_dir, or the current user's own cache directory in the temp directory"""
+    import tempfile
+    return cache_dir or os.path.join(tempfile.gettempdir(), 'check_http_json_cache-%d' % os.getuid())
+
+def makeCacheDirectory(directory):
+    """Create directory readable by the current user only, refusing one that another user owns"""
+    import errno
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.stat(directory).st_uid != os.getuid():
+        raise PermissionError(errno.EPERM, 'Owned by another user', directory)
+
+def _trusted(st):
+    """Whether a cached file was written by the current user and cannot have been changed by others since"""
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+def requestIdentity(args):
+    """Return what besides the URL tells requests apart: the POST data, headers, auth and Unix socket"""
+    return [args.data or '', args.headers or '', args.auth or ''] + ([args.unix_socket] if args.unix_socket else [])
+
+class CacheError(Exception):
+    pass
+
+class ResponseCache:
+    """On-disk cache of response bodies keyed by request, fetched once by concurrent checks"""
+    def __init__(self, directory, ttl, max_size):
+        self.directory = cacheDirectory(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def key(self, url, args):
+        import hashlib
+        request = '\0'.join([url] + requestIdentity(args))
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def fetch(self, key, loader, deadline=None, timeout=None):
+        """Return (body, hit, age) for key, calling loader() unless a fresh trusted body is cached. Raises CacheError"""
+        import fcntl
+        path = os.path.join(self.directory, key + '.body')
+        try:
+            makeCacheDirectory(self.directory)
+            lock = open(os.path.join(self.directory, key + '.lock'), 'a')
+        except OSError as e:
+            raise CacheError(e.strerror or e)
+        with lock:
+            lockFile(lock, deadline, timeout)
+            try:
+                cached = self.read(path)
+                if cached is not None:
+                    return cached
+                body = loader()
+                self.write(path, body)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        try:
+            self.evict()
+        except OSError as e:
+            raise CacheError(e.strerror or e)
+        return body, False, 0
+
+    def read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                age = time.time() - st.st_mtime
+                if _trusted(st) and 0 <= age < self.ttl:
+                    return f.read(), True, age
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise CacheError(e.strerror or e)
+        return None
+
+    def write(self, path, body):
+        import tempfile
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(body)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            raise CacheError(e.strerror or e)
+
+    def evict(self):
+        """Remove the oldest bodies until the cache fits in max_size bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.body'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class CounterStore:
+    """Previous values of the #rate and #delta keys of one target, kept between checks in a JSON file under the
+    key without its suffix"""
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.now = time.time()
+        self.previous = self.read()
+        self.current = {}
+
+    @classmethod
+    def forArgs(cls, args):
+        """Return the store of the target of args: its hosts, port, paths and request, or its --input file"""
+        import hashlib, tempfile
+        target = os.path.abspath(args.input) if args.input and args.input != '-' else args.input
+        signature = '\0'.join(str(part) for part in [args.ssl, ','.join(args.hosts), args.port, '\0'.join(args.path or ()), target]
+                               + requestIdentity(args))
+        directory = args.state_dir or os.path.join(tempfile.gettempdir(), 'check_http_json_state-%d' % os.getuid())
+        return cls(os.path.join(directory, hashlib.sha256(signature.encode()).hexdigest() + '.state'), args.state_ttl)
+
+    def read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                # Values another user could have written are not trusted, the counters start over
+                if not _trusted(os.fstat(f.fileno())):
+                    return {}
+                entries = json.loads(f.read())
+            return dict((key, entry) for key, entry in entries.items() if self.now - entry[1] < self.ttl)
+        except (OSError, ValueError, AttributeError, TypeError, IndexError):
+            # A missing or damaged file starts over, like a first check
+            return {}
+
+    def convert(self, key, counter, value):
+        """Return the rate per second or the delta of value since the previous check, NOT_FOUND on the first one"""
+        if isinstance(value, Matches):
+            converted = ((labels, self.convertValue(Matches.label(key, labels), counter, v)) for labels, v in value)
+            return Matches((labels, v) for labels, v in converted if v != NOT_FOUND)
+        return self.convertValue(key, counter, value)
+
+    def convertValue(self, key, counter, value):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return NOT_FOUND
+        self.current[key] = [int(number) if number.is_integer() else number, round(self.now, 3)]
+        previous = self.previous.get(key)
+        if previous is None:
+            return NOT_FOUND
+        last, then = previous
+        delta = number - last
+        if delta < 0:
+            # The counter was reset, e.g. by a restart, and has counted up from zero since
+            delta = number
+        if counter == 'rate':
+            if self.now <= then:
+                return NOT_FOUND
+            delta = round(delta / (self.now - then), 3)
+        if isinstance(delta, float) and delta.is_integer():
+            delta = int(delta)
+        return delta
+
+    def save(self, deadline=None, timeout=None):
+        """Merge the values seen by this check into the file"""
+        import fcntl, tempfile
+        if not self.current:
+            return
+        directory = os.path.dirname(self.path)
+        makeCacheDirectory(directory)
+        with open(self.path + '.lock', 'a') as lock:
+            lockFile(lock, deadline, timeout)
+            try:
+                entries = self.read()
+                entries.update(self.current)
+                fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(entries, f, separators=(',', ':'))
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def buildUrl(args, path=None):
+    if args.ssl:
+        url = "https://%s" % args.host
+    else:
+        url = "http://%s" % args.host
+    if args.port: url += ":%s" % args.port
+    if path: url += "/%s" % path
+    return url
+
+def _documentPaths(args):
+    """Return the (path, name) of every document to fetch. A path is named with path>name, and defaults to its own name"""
+    if not args.path:
+        return [(None, None)]
+    return [_getKeyAlias(path) for path in args.path]
+
+class HeadersError(Exception):
+    """-A headers that are not a JSON object"""
+
+def parseHeaders(text):
+    """Return the {name: value} object of the -A option, raising HeadersError for anything else"""
+    try:
+        headers = json.loads(text)
+    except ValueError as e:
+        raise HeadersError(e)
+    if not isinstance(headers, dict):
+        raise HeadersError("expected a JSON object of header names and values")
+    return headers
+
+def fetchJson(args, nagios, pool=None, path=None, name=None, timings=None, node=None, deadline=None):
+    """Fetch and parse the JSON document at path. Returns FETCH_FAILED after reporting the failure to nagios"""
+    import io
+    from http.client import InvalidURL
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+    if timings is None:
+        timings = Timings()
+    url = buildUrl(args, path)
+    location = "%s, socket:%s" % (url, args.unix_socket) if args.unix_socket else url
+    debugPrint(args.debug, "url:%s" % location)
+    # Attempt to reach the endpoint
+    try:
+        req = Request(url)
+        if args.auth:
+            import base64
+            base64str = base64.b64encode(args.auth.encode()).decode()
+            req.add_header('Authorization', 'Basic %s' % base64str)
+        if args.headers:
+            headers = parseHeaders(args.headers)
+            debugPrint(args.debug, "Headers:\n %s" % headers)
+            for header in headers:
+                req.add_header(header, headers[header])
+        if args.compression and not req.has_header('Accept-encoding'):
+            req.add_header('Accept-Encoding', 'gzip, deflate')
+        data = args.data.encode() if args.data else None
+        def openUrl():
+            kwargs = {'data': data}
+            if args.timeout:
+                kwargs['timeout'] = args.timeout
+            if pool is not None:
+                response = pool.urlopen(req, timings=timings, deadline=deadline, unix_socket=args.unix_socket, **kwargs)
+            elif deadline is not None:
+                response = deadline.urlopen(req, data, args.timeout)
+            else:
+                response = urlopen(req, **kwargs)
+            return DecodedResponse(response, timings, args.max_decoded_size, args.max_size, deadline)
+        def download(response):
+            started = time.monotonic()
+            try:
+                body = response.read()
+            finally:
+                response.close()
+            timings.add('download', started)
+            return body
+        if args.cache_ttl:
+            cache = ResponseCache(args.cache_dir, args.cache_ttl, args.cache_max_size)
+            body, hit, age = cache.fetch(cache.key(url, args), lambda: download(openUrl()), deadline, args.timeout)
+            debugPrint(args.debug, "cache hit:%s age:%ds" % (hit, age))
+            suffix = '_%s' % name if name is not None else ''
+            nagios.append_metrics("'cache_hit%s'=%d;;;0;1 'cache_age%s'=%ds " % (suffix, hit, suffix, age), '', '')
+            response = io.BytesIO(body)
+        else:
+            response = openUrl()
+        try:
+            data = parseJson(args, response, tuple(n for n in (node, name) if n is not None), timings)
+        finally:
+            response.close()
+        if deadline is not None:
+            deadline.check()
+    except CacheError as e:
+        nagios.append_unknown("CacheError[%s], cache:%s" % (e, cacheDirectory(args.cache_dir)), '')
+    except DeadlineExceeded as e:
+        nagios.append_critical("DeadlineExceeded[%s], url:%s" % (e, location), '')
+    except ResponseTooLarge as e:
+        nagios.append_unknown("ResponseTooLarge[%s], url:%s" % (e, location), '')
+    except HeadersError as e:
+        nagios.append_unknown("HeadersError[%s], headers:%s" % (e, args.headers), '')
+    except InvalidURL as e:
+        nagios.append_unknown("InvalidURL[%s], url:%s" % (e, location), '')
+    except HTTPError as e:
+        nagios.append_unknown("HTTPError[%s], url:%s" % (str(e.code), location), '')
+    except URLError as e:
+        nagios.append_critical("URLError[%s], url:%s" % (str(e.reason), location), '')
+    except DecodingError as e:
+        nagios.append_unknown("DecodingError[%s], url:%s" % (e, location), '')
+    except ValueError as e:
+        nagios.append_unknown("JSONError[%s], url:%s" % (e, location), '')
+    else:
+        return data
+    return FETCH_FAILED
+
+def parseJson(args, response, names=(), timings=None):
+    """Parse the JSON document read from the file like response, projected with --stream or aggregated with --ndjson"""
+    if timings is None:
+        timings = Timings()
+    if args.ndjson:
+        started = time.monotonic()
+        data = RecordAggregates(_ruleKeys(args), args.separator or '.', args.json_backend).feed(response)
+        timings.add('parse', started)
+        size = data.size
+    elif args.stream:
+        started = time.monotonic()
+        projector = StreamingProjector(response, _rulePaths(args, names), backend=args.json_backend)
+        data = projector.parse()
+        timings.add('parse', started)
+        size = projector.size
+    else:
+        import io
+        started = time.monotonic()
+        body = response.read()
+        if not isinstance(response, io.BytesIO):
+            # A body from --cache-ttl was timed while the cache downloaded it
+            timings.add('download', started)
+        size = len(body)
+        started = time.monotonic()
+        data = loadJson(body, args.json_backend)
+        timings.add('parse', started)
+    timings.size += size
+    debugPrint(args.debug, "json backend:%s" % (jsonDecoder(args.json_backend)[0] if args.json_backend or size >= FAST_DECODER_MIN_SIZE else 'json'))
+    if args.debug:
+        # The whole document can be huge, only show what the rules refer to
+        debugPrint(args.debug, 'json, as far as the rules reach:')
+        debugPrint(args.debug, data if args.ndjson else touchedSubtrees(data, _rulePaths(args, names)), True)
+    return data
+
+def readJson(args, nagios, timings=None):
+    """Read and parse the --input document, or stdin for "-". Returns FETCH_FAILED after reporting a failure to nagios"""
+    try:
+        if args.input == '-':
+            return parseJson(args, sys.stdin.buffer, timings=timings)
+        with open(args.input, 'rb') as f:
+            return parseJson(args, f, timings=timings)
+    except OSError as e:
+        nagios.append_unknown("InputError[%s], input:%s" % (e.strerror or e, args.input), '')
+    except ValueError as e:
+        nagios.append_unknown("JSONError[%s], input:%s" % (e, args.input), '')
+    return FETCH_FAILED
+
+def fetchDocuments(args, nagios, pool=None, timings=None, node=None, deadline=None):
+    """Read the --input document or fetch the documents of args.host. Returns FETCH_FAILED after reporting a failure"""
+    documents = _documentPaths(args)
+    own_pool = pool is None and not args.input and (len(documents) > 1 or args.timings or deadline is not None or args.unix_socket)
+    if own_pool:
+        pool = ConnectionPool()
+    if args.input:
+        data = readJson(args, nagios, timings)
+    elif len(documents) == 1:
+        data = fetchJson(args, nagios, pool, documents[0][0], timings=timings, node=node, deadline=deadline)
+    else:
+        data = {}
+        for path, name in documents:
+            data[name] = fetchJson(args, nagios, pool, path, name, timings, node, deadline)
+        if any(document is FETCH_FAILED for document in data.values()):
+            data = FETCH_FAILED
+    if own_pool:
+        pool.close()
+    return data
+
+def checkRules(args, data, nagios, timings, deadline=None):
+    """Apply the rules to the returned JSON data, keeping the values of #rate and #delta keys for the next check"""
+    started = time.monotonic()
+    program = RuleProgram.fromArgs(args)
+    counters = CounterStore.forArgs(args) if program.counters else None
+    trace = EngineTrace(program) if args.trace else None
+    JsonRuleProcessor(data, args, counters, trace).report(nagios)
+    if counters is not None:
+        try:
+            counters.save(deadline, args.timeout)
+        except DeadlineExceeded as e:
+            nagios.append_critical("DeadlineExceeded[%s], state:%s" % (e, counters.path), '')
+        except OSError as e:
+            nagios.append_unknown("StateError[%s], state:%s" % (e.strerror or e, counters.path), '')
+    timings.add('rules', started)
+    if trace is not None:
+        try:
+            trace.write(trace.report(args.input or ','.join(args.hosts), timings), args.trace)
+        except OSError as e:
+            nagios.append_unknown("TraceError[%s], trace:%s" % (e.strerror or e, args.trace), '')
+
+def reportTimings(args, nagios, timings):
+    if args.timings:
+        total = timings.total()
+        failures = []
+        for r in (args.timings_warning, args.timings_critical):
+            total_range = Range(r, 'str') if r else None
+            if total_range is not None and total_range.violates(total):
+                failures.append(total_range.failure('total', '%.3fms' % total))
+            else:
+                failures.append('')
+        nagios.append_metrics(timings.perfdata(total, args.timings_warning, args.timings_critical), *failures)
+
+def compileRules(args, nagios):
+    """Compile the rules up front, returning False after reporting an invalid rule or rules file to nagios"""
+    try:
+        program = RuleProgram.fromArgs(args)
+        # Bad aggregates and selectors surface here rather than half way through the check
+        for key in program.keys:
+            JsonPath.compile(key, args.separator or '.')
+        if args.ndjson:
+            RecordAggregates(program.keys, args.separator or '.')
+    except (OSError, ValueError) as e:
+        nagios.append_unknown("RulesError[%s], rules:%s" % (e, getattr(args, 'rules_file', None) or 'arguments'), '')
+        return False
+    return True
+
+def runCheck(args, pool=None):
+    """Run a single check end to end and return the NagiosHelper holding its result"""
+    if len(args.hosts) > 1:
+        return runCluster(args, pool)
+    nagios = NagiosHelper(args.long_output, args.max_output)
+    timings = Timings()
+    if not compileRules(args, nagios):
+        return nagios
+    deadline = Deadline(args.deadline) if args.deadline else None
+    data = fetchDocuments(args, nagios, pool, timings, deadline=deadline)
+    if data is not FETCH_FAILED:
+        checkRules(args, data, nagios, timings, deadline)
+    reportTimings(args, nagios, timings)
+    return nagios
+
+def runCluster(args, pool=None):
+    """Check every host of args.hosts concurrently and combine the nodes into one result"""
+    import copy
+    from concurrent.futures import ThreadPoolExecutor
+    nagios = NagiosHelper(args.long_output, args.max_output)
+    if not compileRules(args, nagios):
+        return nagios
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool()
+    deadline = Deadline(args.deadline) if args.deadline else None
+
+    def checkNode(host):
+        node_args = copy.copy(args)
+        node_args.host, node_args.hosts = host, [host]
+        node, timings = NagiosHelper(), Timings()
+        data = fetchDocuments(node_args, node, pool, timings, host if args.aggregate else None, deadline)
+        if data is not FETCH_FAILED and not args.aggregate:
+            checkRules(node_args, data, node, timings, deadline)
+        reportTimings(node_args, node, timings)
+        return node, data
+
+    with ThreadPoolExecutor(max_workers=len(args.hosts)) as executor:
+        nodes = list(executor.map(checkNode, args.hosts))
+    if own_pool:
+        pool.close()
+    # UNKNOWN ranks after CRITICAL, a node that could not be checked is no better than a failing one
+    codes = sorted(node.getCode() for node, _ in nodes)
+    quorum = args.quorum or len(args.hosts)
+    code = codes[quorum - 1]
+    for host, (node, _) in zip(args.hosts, nodes):
+        nagios.include(node, host)
+    nagios.summary = " %d of %d nodes OK, quorum %d." % (codes.count(OK_CODE), len(codes), quorum)
+    if args.aggregate:
+        documents = dict((host, data) for host, (_, data) in zip(args.hosts, nodes) if data is not FETCH_FAILED)
+        cluster = NagiosHelper()
+        if documents:
+            checkRules(args, documents, cluster, Timings(), deadline)
+        nagios.details.extend(cluster.details)
+        nagios.warnings.extend(cluster.warnings)
+        nagios.criticals.extend(cluster.criticals)
+        nagios.unknowns.extend(cluster.unknowns)
+        nagios.perfdata.extend(cluster.perfdata)
+        code = max(code, cluster.getCode())
+    nagios.code = code
+    return nagios
+
+# Options naming a file or directory, resolved against the working directory of a daemon's client
+PATH_OPTIONS = ('input', 'rules_file', 'trace', 'state_dir', 'cache_dir')
+
+def resolvePaths(args, cwd):
+    """Make the relative file and directory options of args relative to cwd instead of the current directory"""
+    for option in PATH_OPTIONS:
+        value = getattr(args, option, None)
+        if value and value != '-':
+            setattr(args, option, os.path.join(cwd, value))
+
+def runArgv(argv, pool=None, args_cache=None, cwd=None, debug=None):
+    """Run the check described by argv and return (code, message), reporting bad arguments and crashes as UNKNOWN"""
+    if isinstance(argv, str):
+        import shlex
+        argv = shlex.split(argv)
+    try:
+        key = (cwd,) + tuple(argv)
+        args = args_cache.get(key) if args_cache is not None else None
+        if args is None:
+            args = parseArgs(argv)
+            if args.batch or args.daemon:
+                return UNKNOWN_CODE, "%s: Invalid arguments %s, --batch and --daemon cannot run inside a batch or daemon check" % (
+                    NagiosHelper.message_prefixes[UNKNOWN_CODE], ' '.join(argv))
+            if cwd is not None:
+                resolvePaths(args, cwd)
+            if args_cache is not None:
+                remember(args_cache, key, args)
+        if args.debug and debug is not None:
+            # The cached arguments are shared by concurrent checks
+            import copy
+            args = copy.copy(args)
+            args.debug = debug
+        nagios = runCheck(args, pool)
+    except SystemExit:
+        return UNKNOWN_CODE, "%s: Invalid arguments %s" % (NagiosHelper.message_prefixes[UNKNOWN_CODE], ' '.join(argv))
+    except Exception as e:
+        return UNKNOWN_CODE, "%s: %s" % (NagiosHelper.message_prefixes[UNKNOWN_CODE], repr(e))
+    return nagios.getCode(), nagios.getMessage()
+
+def loadManifest(path):
+    """Read a batch manifest, raising ValueError unless it is a list of objects"""
+    with open(path) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list) or not all(isinstance(entry, dict) for entry in manifest):
+        raise ValueError('expected a list of {"host_name", "service_description", "args"} objects')
+    return manifest
+
+def runBatch(manifest, workers):
+    """Run every check of a manifest on a bounded thread pool and return passive check result lines in manifest order"""
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ConnectionPool()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Debug output goes to stderr, stdout only carries the passive check results
+        results = list(executor.map(lambda entry: runArgv(entry.get('args', []), pool, debug=sys.stderr), manifest))
+    now = int(time.time())
+    # External commands are single lines, Nagios expands the escaped line breaks of long output
+    return ["[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s" % (now, entry.get('host_name', ''), entry.get('service_description', ''), code, message.replace('\n', '\\n'))
+        for entry, (code, message) in zip(manifest, results)]
+
+def createDaemon(socket_path):
+    """Create the server answering one {"argv", "cwd"} JSON line per connection over a Unix socket only its user can use"""
+    import socketserver
+    pool = ConnectionPool()
+    args_cache = {}
+
+    class CheckHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            import io
+            debug = io.StringIO()
+            try:
+                request = json.loads(self.rfile.readline().decode())
+                argv, cwd = request['argv'], request['cwd']
+            except (ValueError, TypeError, KeyError) as e:
+                code, output = UNKNOWN_CODE, "%s: Invalid request %s" % (NagiosHelper.message_prefixes[UNKNOWN_CODE], e)
+            else:
+                code, output = runArgv(argv, pool, args_cache, cwd, debug)
+            self.wfile.write((json.dumps({'code': code, 'output': output, 'debug': debug.getvalue()}) + '\n').encode())
+
+    class CheckServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def server_close(self):
+            socketserver.ThreadingUnixStreamServer.server_close(self)
+            pool.close()
+
+    import errno, stat
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        pass
+    else:
+        # Replace the socket a previous daemon left behind, never anything else
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(errno.EEXIST, "Not a socket", socket_path)
+        os.unlink(socket_path)
+    # Checks read and write files as the daemon's user, so only that user may connect. The umask creates the
+    # socket that way, rather than a chmod after the bind that other users could race
+    umask = os.umask(0o177)
+    try:
+        return CheckServer(socket_path, CheckHandler)
+    finally:
+        os.umask(umask)
+
+def runDaemon(socket_path):
+    """Serve checks over socket_path until SIGTERM or Ctrl-C, then remove the socket. Returns the exit code"""
+    import signal
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    # Stopped by a service manager, leave nothing behind like on Ctrl-C. Set before the socket
+    # appears, so a SIGTERM right after it does not skip the cleanup
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server = createDaemon(socket_path)
+    except OSError as e:
+        print("%s: %s" % (NagiosHelper.message_prefixes[UNKNOWN_CODE], e))
+        return UNKNOWN_CODE
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    return OK_CODE
+
+def main(argv=None):
+    """Program entry point"""
+    args = parseArgs(argv)
+    if args.batch:
+        try:
+            manifest = loadManifest(args.batch)
+        except (OSError, ValueError) as e:
+            # stdout feeds the Nagios command file, which has no use for this line
+            print("%s: ManifestError[%s], manifest:%s" % (NagiosHelper.message_prefixes[UNKNOWN_CODE], e, args.batch), file=sys.stderr)
+            exit(UNKNOWN_CODE)
+        for line in runBatch(manifest, args.batch_workers):
+            print(line)
+        exit(OK_CODE)
+    if args.daemon:
+        exit(runDaemon(args.daemon))
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        nagios = profiler.runcall(runCheck, args)
+        profiler.dump_stats(args.profile)
+    else:
+        nagios = runCheck(args)
+    # Print Nagios specific string and exit appropriately
+    print(nagios.getMessage())
+    exit(nagios.getCode())
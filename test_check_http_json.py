@@ -0,0 +1,1080 @@
+#!/usr/bin/env python3
+
+"""
+Check HTTP JSON Nagios Plugin tests, run with ./test_check_http_json.py or ./check_http_json.py UnitTest
+"""
+
+import base64
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from check_http_json_engine import *
+from check_http_json_engine import _decoders, _ruleKeys
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_http_json.py')
+
+
+class RulesHelper:
+    field_type = 'str'
+    separator = '.'
+    debug = False
+    key_threshold_warning, key_value_list, key_list, key_threshold_critical, \
+    key_value_list_critical, key_list_critical, metric_list = None, None, None, None, None, None, None
+
+    def dash_m(self, data):
+        self.metric_list = data
+        return self
+
+    def dash_e(self, data):
+        self.key_list = data
+        return self
+
+    def dash_E(self, data):
+        self.key_list_critical = data
+        return self
+
+    def dash_q(self, data):
+        self.key_value_list = data
+        return self
+
+    def dash_Q(self, data):
+        self.key_value_list_critical = data
+        return self
+
+    def dash_w(self, data):
+        self.key_threshold_warning = data
+        return self
+
+    def dash_c(self, data):
+        self.key_threshold_critical = data
+        return self
+
+class JsonServer:
+    """Local stand-in HTTP server answering GET/POST with the JSON document registered for each path,
+    compressed with encoding when the request accepts it, or with any given encoder ({name: function}).
+    Listens on unix_socket instead of TCP when given, or on the IPv6 loopback with ipv6."""
+    def __init__(self, documents, encoding=None, unix_socket=None, ipv6=False):
+        import zlib, gzip
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from socketserver import ThreadingUnixStreamServer
+        documents = dict((path, body if isinstance(body, bytes) else json.dumps(body).encode()) for path, body in documents.items())
+        encoders = {'gzip': gzip.compress, 'deflate': zlib.compress, 'raw': lambda body: zlib.compress(body)[2:-4]}
+        if isinstance(encoding, dict):
+            encoders.update(encoding)
+            encoding = list(encoding)[0]
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                self.server.requests.append((self.command, self.headers.get('Host'), self.headers.get('Authorization')))
+                self.server.agents.append(self.headers.get('User-Agent'))
+                body = documents.get(self.path.split('?')[0])
+                if self.headers.get('Content-Length'):
+                    self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                name = 'deflate' if encoding == 'raw' else encoding
+                if body is not None and encoding and name in (self.headers.get('Accept-Encoding') or ''):
+                    body = encoders[encoding](body)
+                    self.send_header('Content-Encoding', name)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+            do_POST = do_GET
+            def handle(self):
+                try:
+                    BaseHTTPRequestHandler.handle(self)
+                except ConnectionResetError:
+                    # Checks hang up on bodies they stop reading early
+                    pass
+            def log_message(self, *args):
+                pass
+        if unix_socket:
+            self.server = ThreadingUnixStreamServer(unix_socket, Handler)
+            self.server.daemon_threads = True
+            self.host, self.port = 'localhost', None
+        elif ipv6:
+            import socket
+            class Server(ThreadingHTTPServer):
+                address_family = socket.AF_INET6
+            self.server = Server(('::1', 0), Handler)
+            self.host = '[::1]'
+            self.port = self.server.server_address[1]
+        else:
+            self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            self.host = '127.0.0.1'
+            self.port = self.server.server_address[1]
+        self.server.requests = []
+        self.server.agents = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class UnitTest(unittest.TestCase):
+    rules = RulesHelper()
+
+    def tempdir(self):
+        import shutil
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
+    def check_data(self, args, jsondata, code):
+        data = json.loads(jsondata)
+        nagios = NagiosHelper()
+        processor = JsonRuleProcessor(data, args)
+        nagios.append_warning(*processor.checkWarning())
+        nagios.append_critical(*processor.checkCritical())
+        nagios.append_metrics(*processor.checkMetrics())
+        self.assertEqual(code, nagios.getCode())
+
+    def test_metrics(self):
+        self.check_data(RulesHelper().dash_m(['metric,,1:4,1:5']), '{"metric": 5}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_m(['metric,,1:5,1:4']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_m(['metric,,1:5,1:5,6,10']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_m(['metric,,1:5,1:5,1,4']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_m(['metric,s,@1:4,@6:10,1,10']), '{"metric": 5}', OK_CODE)
+
+    def test_exists(self):
+        self.check_data(RulesHelper().dash_e(['nothere']), '{"metric": 5}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_E(['nothere']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_e(['metric']), '{"metric": 5}', OK_CODE)
+
+    def test_equality(self):
+        self.check_data(RulesHelper().dash_q(['metric,6']), '{"metric": 5}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_Q(['metric,6']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_q(['metric,5']), '{"metric": 5}', OK_CODE)
+
+    def test_warning_thresholds(self):
+        self.check_data(RulesHelper().dash_w(['metric,5']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,5:']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,~:5']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,1:5']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@5']), '{"metric": 6}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@5:']), '{"metric": 4}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@~:5']), '{"metric": 6}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@1:5']), '{"metric": 6}', OK_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,5']), '{"metric": 6}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,5:']), '{"metric": 4}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,~:5']), '{"metric": 6}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,1:5']), '{"metric": 6}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@5']), '{"metric": 5}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@5:']), '{"metric": 5}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@~:5']), '{"metric": 5}', WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['metric,@1:5']), '{"metric": 5}', WARNING_CODE)
+
+    def test_critical_thresholds(self):
+        self.check_data(RulesHelper().dash_c(['metric,5']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,5:']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,~:5']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,1:5']), '{"metric": 5}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@5']), '{"metric": 6}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@5:']), '{"metric": 4}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@~:5']), '{"metric": 6}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@1:5']), '{"metric": 6}', OK_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,5']), '{"metric": 6}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,5:']), '{"metric": 4}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,~:5']), '{"metric": 6}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,1:5']), '{"metric": 6}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@5']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@5:']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@~:5']), '{"metric": 5}', CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['metric,@1:5']), '{"metric": 5}', CRITICAL_CODE)
+
+    def test_separator(self):
+        rules = RulesHelper()
+        rules.separator = '_'
+        self.check_data(
+            rules.dash_q(['(0)_gauges_jvm.buffers.direct.capacity(1)_value,1234']),
+            '[{ "gauges": { "jvm.buffers.direct.capacity": [{"value": 215415},{"value": 1234}]}}]',
+            OK_CODE)
+
+    def test_array_selector(self):
+        name = base64.b64encode(b'java.lang:type=Memory (heap),name=Heap').decode()
+        data = '{"beans": [{"name": "other", "used": 1}, {"name": "java.lang:type=Memory (heap),name=Heap", "used": 7}]}'
+        self.check_data(RulesHelper().dash_q(['beans.(name=%s).used,7' % name]), data, OK_CODE)
+        self.check_data(RulesHelper().dash_q(['beans(1).used,7']), data, OK_CODE)
+        self.check_data(RulesHelper().dash_E(['beans(2).used']), data, CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_q(['values(1),0']), '{"values": [1, 0]}', OK_CODE)
+
+    def test_resolved_once(self):
+        helper = JsonHelper({"a": {"b": [{"c": 5}]}}, '.')
+        self.assertEqual(5, helper.get('a.b(0).c'))
+        self.assertEqual(NOT_FOUND, helper.get('a.b(1).c'))
+        helper.data = {}
+        self.assertEqual(5, helper.get('a.b(0).c'))
+        self.assertTrue(helper.gt('a.b(0).c', '4'))
+
+    def test_selector_index(self):
+        key = lambda name: 'beans.(name=%s).v' % base64.b64encode(name.encode()).decode()
+        helper = JsonHelper({"beans": [{"name": "a", "v": 1}, {"name": "b", "v": 2}, {"name": "a", "v": 3}]}, '.')
+        self.assertEqual(1, helper.get(key('a')))
+        self.assertEqual(2, helper.get(key('b')))
+        self.assertEqual(NOT_FOUND, helper.get(key('c')))
+        self.assertEqual(1, len(helper.indexes))
+        # The index outlives the compiled paths, which are dropped when too many are kept
+        JsonPath._compiled.clear()
+        self.assertEqual('b', helper.get(key('b')[:-1] + 'name'))
+        self.assertEqual(1, len(helper.indexes))
+
+    def test_batch(self):
+        with JsonServer({'/jmx': {"metric": 5}, '/other': {"metric": 12}}) as server:
+            target = ['-H', server.host, '-P', str(server.port)]
+            manifest = [
+                {"host_name": "web1", "service_description": "ok", "args": target + ['-p', 'jmx', '-w', 'metric,1:10', '-d']},
+                {"host_name": "web1", "service_description": "crit", "args": ' '.join(target + ['-p', 'other', '-c', 'metric,1:10'])},
+                {"host_name": "web2", "service_description": "missing", "args": target + ['-p', 'missing']},
+                {"host_name": "web2", "service_description": "bad", "args": ['--no-such-option']},
+            ]
+            with contextlib.redirect_stderr(io.StringIO()) as stderr, contextlib.redirect_stdout(io.StringIO()) as stdout:
+                lines = runBatch(manifest, 2)
+            single = runCheck(parseArgs(manifest[1]['args'].split()))
+        self.assertEqual(4, len(lines))
+        self.assertIn('] PROCESS_SERVICE_CHECK_RESULT;web1;ok;0;OK:', lines[0])
+        self.assertTrue(lines[1].endswith(';web1;crit;2;%s' % single.getMessage()))
+        self.assertIn(';web2;missing;3;UNKNOWN:HTTPError[404]', lines[2])
+        self.assertIn(';web2;bad;3;UNKNOWN: Invalid arguments', lines[3])
+        # Debug output stays out of the passive check results
+        self.assertEqual('', stdout.getvalue())
+        self.assertIn("json, as far as the rules reach:\n{'metric': 5}", stderr.getvalue())
+        # Checks of a batch cannot start a batch or daemon of their own
+        for nested in (['--batch', 'other.json'], ['--daemon', 'other.sock']):
+            code, message = runArgv(nested)
+            self.assertEqual(UNKNOWN_CODE, code)
+            self.assertIn('--batch and --daemon cannot run inside', message)
+        # A manifest that cannot be read or is not a list of checks is UNKNOWN, not a traceback
+        directory = self.tempdir()
+        for name, content in (('missing.json', None), ('invalid.json', '[{'), ('object.json', '{"args": []}')):
+            path = os.path.join(directory, name)
+            if content is not None:
+                with open(path, 'w') as f:
+                    f.write(content)
+            result = subprocess.run([sys.executable, PLUGIN, '--batch', path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.assertEqual(UNKNOWN_CODE, result.returncode)
+            self.assertTrue(result.stderr.startswith(b'UNKNOWN: ManifestError['), result.stderr)
+            self.assertEqual(b'', result.stdout)
+
+    def test_connection_pool(self):
+        pool = ConnectionPool()
+        with JsonServer({'/jmx': {"metric": 5}}) as server:
+            args = parseArgs(['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'metric,5'])
+            self.assertEqual(OK_CODE, runCheck(args, pool).getCode())
+            conn = pool.idle[('http', server.host, server.port)][0]
+            self.assertEqual(OK_CODE, runCheck(args, pool).getCode())
+            self.assertEqual([conn], pool.idle[('http', server.host, server.port)])
+            # Pooled requests identify like urllib ones
+            self.assertEqual(OK_CODE, runCheck(args).getCode())
+            self.assertEqual(1, len(set(server.server.agents)))
+            self.assertTrue(server.server.agents[0].startswith('Python-urllib/'))
+            args.path = ['missing']
+            self.assertIn('HTTPError[404]', runCheck(args, pool).getMessage())
+            # Proxies from the environment apply as they do without a pool
+            import socket
+            with socket.socket() as dead:
+                dead.bind(('127.0.0.1', 0))
+                environ = dict((k, v) for k, v in os.environ.items() if not k.lower().endswith('_proxy'))
+                environ['http_proxy'] = 'http://127.0.0.1:%d' % dead.getsockname()[1]
+                argv = [sys.executable, PLUGIN, '-H', server.host, '-P', str(server.port), '-p', 'jmx', '--timings']
+                result = subprocess.run(argv, env=environ, stdout=subprocess.PIPE)
+                self.assertIn(b'URLError', result.stdout)
+                environ['no_proxy'] = server.host
+                self.assertEqual(OK_CODE, subprocess.run(argv, env=environ, stdout=subprocess.PIPE).returncode)
+        pool.close()
+
+        # A server answering one request per connection, then hanging up on the next one unanswered
+        import socket
+        requests = []
+        def serve(conn):
+            with conn, conn.makefile('rb') as f:
+                for answer in (True, False):
+                    head = [line for line in iter(f.readline, b'\r\n') if line]
+                    if not head:
+                        return
+                    length = [int(line.split(b':')[1]) for line in head if line.lower().startswith(b'content-length:')]
+                    requests.append(head[0].split()[0] + (b' ' + f.read(length[0]) if length else b''))
+                    if answer:
+                        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 12\r\n\r\n{"metric":5}')
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(4)
+            threading.Thread(target=lambda: [threading.Thread(target=serve, args=(listener.accept()[0],), daemon=True).start() for _ in range(4)],
+                             daemon=True).start()
+            target = ['-H', '127.0.0.1', '-P', str(listener.getsockname()[1]), '-q', 'metric,5']
+            pool = ConnectionPool()
+            self.assertEqual([OK_CODE, OK_CODE], [runCheck(parseArgs(target), pool).getCode() for _ in range(2)])
+            self.assertEqual([b'GET', b'GET', b'GET'], requests)
+            # A POST is not sent again, the server may have acted on it
+            del requests[:]
+            pool.close()
+            self.assertEqual([OK_CODE, CRITICAL_CODE], [runCheck(parseArgs(target + ['-D', 'once']), pool).getCode() for _ in range(2)])
+            self.assertEqual([b'POST once', b'POST once'], requests)
+            pool.close()
+
+    def test_daemon(self):
+        socket_path = os.path.join(self.tempdir(), 'check.sock')
+        client = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_http_json_client.py')
+        with JsonServer({'/jmx': {"metric": 12}}) as server:
+            daemon = createDaemon(socket_path)
+            threading.Thread(target=daemon.serve_forever, daemon=True).start()
+            # Other users cannot connect, the checks run with the daemon's files and permissions
+            self.assertEqual(0o600, os.stat(socket_path).st_mode & 0o777)
+            import socket
+            for request in (b'["-H", "x"]\n', b'{"argv": ["-H", "x"]}\n'):
+                with socket.socket(socket.AF_UNIX) as client_socket:
+                    client_socket.connect(socket_path)
+                    client_socket.sendall(request)
+                    reply = json.loads(client_socket.makefile().readline())
+                self.assertEqual(UNKNOWN_CODE, reply['code'])
+                self.assertIn('Invalid request', reply['output'])
+            try:
+                argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-w', 'metric,1:10']
+                result = subprocess.run([sys.executable, client, '--socket', socket_path] + argv, stdout=subprocess.PIPE)
+                self.assertEqual(WARNING_CODE, result.returncode)
+                self.assertEqual(runCheck(parseArgs(argv)).getMessage(), result.stdout.decode().strip())
+                # Relative paths are the client's, and debug output goes to the client
+                directory = self.tempdir()
+                with open(os.path.join(directory, 'status.json'), 'w') as f:
+                    json.dump({"status": "UP"}, f)
+                result = subprocess.run([sys.executable, client, '--socket', socket_path, '-i', 'status.json', '-q', 'status,UP', '-d'],
+                                        stdout=subprocess.PIPE, cwd=directory)
+                self.assertEqual(OK_CODE, result.returncode)
+                self.assertIn(b"json, as far as the rules reach:\n{'status': 'UP'}\n", result.stdout)
+                self.assertTrue(result.stdout.endswith(b'OK: Value for key status (UP) does match UP.\n'))
+            finally:
+                daemon.shutdown()
+                daemon.server_close()
+        result = subprocess.run([sys.executable, client, '--socket', socket_path, '-H', 'x'], stdout=subprocess.PIPE)
+        self.assertEqual(UNKNOWN_CODE, result.returncode)
+        # The socket left behind is replaced, any other file is left alone
+        createDaemon(socket_path).server_close()
+        path = os.path.join(self.tempdir(), 'check.sock')
+        with open(path, 'w') as f:
+            f.write('keep')
+        result = subprocess.run([sys.executable, PLUGIN, '--daemon', path], stdout=subprocess.PIPE)
+        self.assertEqual(UNKNOWN_CODE, result.returncode)
+        self.assertIn(b'Not a socket', result.stdout)
+        with open(path) as f:
+            self.assertEqual('keep', f.read())
+        # A daemon that does not answer gives UNKNOWN after the client timeout
+        os.unlink(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as hung:
+            hung.bind(socket_path)
+            hung.listen(1)
+            environ = dict(os.environ, CHECK_HTTP_JSON_TIMEOUT='0.5')
+            result = subprocess.run([sys.executable, client, '--socket', socket_path, '-H', 'x'], stdout=subprocess.PIPE, env=environ)
+        self.assertEqual(UNKNOWN_CODE, result.returncode)
+        self.assertIn(b'did not answer within 0.5s', result.stdout)
+        # SIGTERM removes the socket
+        os.unlink(socket_path)
+        daemon = subprocess.Popen([sys.executable, PLUGIN, '--daemon', socket_path])
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        daemon.terminate()
+        self.assertEqual(OK_CODE, daemon.wait(10))
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_wildcards(self):
+        data = '{"partitions": [{"lag": 3}, {"lag": 40}, {"lag": 7}, {"lag": 90}, {"other": 1}], "pools": {"eden": {"used": 10}, "old": {"used": 30}}}'
+        self.check_data(RulesHelper().dash_w(['partitions(*).lag#max,50']), data, WARNING_CODE)
+        self.check_data(RulesHelper().dash_w(['partitions(*).lag#avg,~:35']), data, OK_CODE)
+        self.check_data(RulesHelper().dash_c(['partitions(*).lag#count,4:4']), data, OK_CODE)
+        self.check_data(RulesHelper().dash_c(['pools.(*).used#sum,39']), data, CRITICAL_CODE)
+        self.check_data(RulesHelper().dash_c(['pools(*).used,5:30']), data, OK_CODE)
+        self.check_data(RulesHelper().dash_E(['partitions(*).missing']), data, CRITICAL_CODE)
+
+        rules = RulesHelper()
+        rules.top_violators = 2
+        processor = JsonRuleProcessor(json.loads(data), rules)
+        failure, success = processor.checkThresholds(['partitions(*).lag,5'])
+        self.assertEqual(" Value for key partitions(3).lag (90) was outside the range '0 : 5'. Value for key partitions(1).lag (40) was outside the range '0 : 5'."
+            " 1 more values for key partitions(*).lag were outside the range '0 : 5'.", failure)
+        self.assertEqual(" Values for key partitions(*).lag (4) were in range '0 : 100'.", processor.checkThresholds(['partitions(*).lag,100'])[1])
+        self.assertEqual(7, processor.helper.get('partitions(*).lag#p50'))
+        # Percentiles outside 0 < p <= 100 and a --top-violators below 1 are refused
+        for key in ('lag#p0', 'lag#p150', 'lag#p-5'):
+            self.assertIn('is not a percentile between 0 and 100', runCheck(parseArgs(['-i', '-', '-w', key + ',5'])).getMessage())
+        self.assertEqual(NOT_FOUND, processor.helper.get('partitions(*).lag#pending'))
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, parseArgs, ['-i', '-', '-w', 'lag,5', '--top-violators', '0'])
+        self.assertEqual(NOT_FOUND, processor.helper.get('partitions(*).missing#max'))
+        pools = '{"pools": {"a": {"state": "UP"}, "b": {"state": "UP"}, "c": {"state": "DOWN"}, "d": {"state": "FAILED"}}}'
+        processor = JsonRuleProcessor(json.loads(pools), RulesHelper())
+        self.assertEqual(('', " Values for key pools(*).state (4) do match UP:DOWN:FAILED."), processor.checkEquality(['pools(*).state,UP:DOWN:FAILED']))
+        self.assertEqual(" Value for key pools(c).state (DOWN) did not match UP. Value for key pools(d).state (FAILED) did not match UP.",
+                         processor.checkEquality(['pools(*).state,UP'])[0])
+        self.assertEqual(" Value for key p(c) (DOWN) did not match UP:FAILED.", processor.checkEquality(['pools(*).state>p,UP:FAILED'])[0])
+        rules = RulesHelper()
+        rules.top_violators = 1
+        processor = JsonRuleProcessor(json.loads(pools), rules)
+        self.assertEqual(" Value for key pools(c).state (DOWN) did not match UP. 1 more values for key pools(*).state did not match UP.",
+                         processor.checkEquality(['pools(*).state,UP'])[0])
+        metrics = JsonRuleProcessor(json.loads(data), RulesHelper().dash_m(['pools(*).used>pool,B', 'partitions(*).lag#max'])).checkMetrics()
+        self.assertEqual("'pool(eden)'=10B 'pool(old)'=30B 'partitions(*).lag#max'=90 ", metrics[0])
+
+    def test_rule_program(self):
+        rules = RulesHelper().dash_w(['metric,1:10', 'other>o,5']).dash_q(['metric,5']).dash_m(['metric,,1:4,1:6'])
+        program = RuleProgram.fromArgs(rules)
+        self.assertIs(program, RuleProgram.fromArgs(RulesHelper().dash_w(['metric,1:10', 'other>o,5']).dash_q(['metric,5']).dash_m(['metric,,1:4,1:6'])))
+        self.assertEqual(['metric', 'other'], list(program.keys))
+        self.assertEqual((1.0, 10.0, False), (program.warning[0].range.low, program.warning[0].range.high, program.warning[0].range.invert))
+        self.assertEqual(';1:4;1:6', program.metrics[0].suffix)
+        processor = JsonRuleProcessor({"metric": 5}, rules)
+        results = processor.evaluate()
+        self.assertTrue(callable(results[program.warning[0]][1]))
+        self.assertEqual((" Value for key metric (5) was outside the range '1 : 4'.", " Value for key metric (5) was in range '1 : 10'. Value for key o ((None, 'not_found')) was in range '0 : 5'. Value for key metric (5) does match 5."),
+            (processor.checkMetrics()[1], processor.checkWarning()[1]))
+
+    def test_streaming_projection(self):
+        document = {"a": 1, "skip": ["]}\"[", {"k": "\\\\"}], "b": {"c": [[10], 11, {"d": "x,y"}], "e": "\u00e9"}, "beans": [{"name": "n", "v": 2}], "f": 3.25}
+        paths = [JsonPath.compile(key, '.').segments for key in ('b.c(2).d', 'b.e', 'beans.(name=bg==).v', 'missing')]
+        body = json.dumps(document, indent=2).encode()
+        for chunk_size in (1, 7, 4096):
+            data = StreamingProjector(io.BytesIO(body), paths, chunk_size).parse()
+            self.assertEqual({"b": {"c": [None, None, {"d": "x,y"}], "e": "\u00e9"}, "beans": document["beans"]}, data)
+        # Selectors and wildcards keep only what the rules want of each element
+        jmx = {"beans": [{"name": "a", "v": 1, "attrs": {"x": list(range(50))}}, {"name": "b", "v": 2, "w": 3, "attrs": {"x": [1]}}, 7], "tail": 1}
+        paths = [JsonPath.compile(key, '.').segments for key in ('beans.(name=Yg==).v', 'beans(*).attrs.x(0)', 'beans(0).w')]
+        # Elements the buffer holds whole are decoded then cut down, the others walked into
+        for chunk_size in (1, 7, 40, 4096):
+            data = StreamingProjector(io.BytesIO(json.dumps(jmx).encode()), paths, chunk_size).parse()
+            self.assertEqual({"beans": [{"name": "a", "v": 1, "attrs": {"x": [0] + [None] * 49}}, {"name": "b", "v": 2, "attrs": {"x": [1]}}, 7]}, data)
+        for invalid in (b'{"beans": [{"name": "a"}, {"name": "b", "v": }]}', b'{"skip": [{"k": [1, }], "beans": []}'):
+            for chunk_size in (1, 7, 4096):
+                stream = StreamingProjector(io.BytesIO(invalid), paths, chunk_size)
+                self.assertRaises(json.JSONDecodeError, stream.parse)
+        self.assertEqual(2, JsonHelper(data, '.').get('beans.(name=Yg==).v'))
+        # Reading stops once every wanted subtree was seen, so the invalid tail is never parsed
+        stream = io.BytesIO(b'{"a": {"b": 1}, "c": 2, "d": [' + b'1,' * 10000)
+        self.assertEqual({"a": {"b": 1}}, StreamingProjector(stream, [JsonPath.compile('a.b', '.').segments], 16).parse())
+        self.assertEqual(document, StreamingProjector(io.BytesIO(body), [[]]).parse())
+        # Numbers split by a chunk boundary, e.g. read as "12." then "75"
+        for chunk_size in range(1, 12):
+            data = StreamingProjector(io.BytesIO(b'{"f": 12.75e1, "g": [[], null, 2.5]}'), [[('name', 'f')], [('name', 'g'), ('index', 2)]], chunk_size).parse()
+            self.assertEqual({"f": 127.5, "g": [None, None, 2.5]}, data)
+        rules = RulesHelper().dash_q(['b.c(2).d,x', 'a,1']).dash_m(['f'])
+        self.assertEqual(['b.c(2).d', 'a', 'f'], _ruleKeys(rules))
+        with JsonServer({'/jmx': document}) as server:
+            argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'b.e,\u00e9', '-w', 'b.c(1),1:10', '-m', 'f', 'nothere']
+            self.assertEqual(runCheck(parseArgs(argv)).getMessage(), runCheck(parseArgs(argv + ['--stream'])).getMessage())
+        # The default 64KB chunk ends inside 12.75
+        with JsonServer({'/jmx': {"pad": "x" * 65516, "v": 12.75}}) as server:
+            argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-w', 'v,12.5']
+            self.assertIn('(12.75)', runCheck(parseArgs(argv + ['--stream'])).getMessage())
+
+    def test_multiple_paths(self):
+        with JsonServer({'/jmx': {"heap": 5}, '/actuator/health': {"status": "UP"}}) as server:
+            target = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-p', 'actuator/health>health']
+            pool = ConnectionPool()
+            nagios = runCheck(parseArgs(target + ['-w', 'jmx.heap,1:10', '-q', 'health.status,UP', '-m', 'jmx.heap>heap']), pool)
+            self.assertEqual(OK_CODE, nagios.getCode())
+            self.assertIn("'heap'=5", nagios.getMessage())
+            self.assertEqual(1, len(pool.idle[('http', server.host, server.port)]))
+            pool.close()
+            nagios = runCheck(parseArgs(target + ['-Q', 'health.status,DOWN', '--stream']))
+            self.assertEqual(CRITICAL_CODE, nagios.getCode())
+            nagios = runCheck(parseArgs(target + ['-p', 'missing', '-q', 'health.status,UP']))
+            self.assertEqual(UNKNOWN_CODE, nagios.getCode())
+
+    def test_timings(self):
+        with JsonServer({'/jmx': {"metric": 5}}) as server:
+            argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'metric,5']
+            message = runCheck(parseArgs(argv + ['--timings'])).getMessage()
+            for phase in ('dns', 'connect', 'ttfb', 'download', 'parse', 'rules'):
+                self.assertRegex(message, "'%s'=[0-9.]+ms " % phase)
+            self.assertIn("'size'=13B", message)
+            self.assertRegex(message, "'total'=[0-9.]+ms 'size'")
+            nagios = runCheck(parseArgs(argv + ['--timings-critical', '100000']))
+            self.assertEqual(OK_CODE, nagios.getCode())
+            self.assertRegex(nagios.getMessage(), "'total'=[0-9.]+ms;;100000 ")
+            nagios = runCheck(parseArgs(argv + ['--timings-warning', '@0:100000', '--stream']))
+            self.assertEqual(WARNING_CODE, nagios.getCode())
+            self.assertRegex(nagios.getMessage(), "Value for key total \\([0-9.]+ms\\) was inside the range '0 : 100000'")
+        with JsonServer({'/jmx': {"metric": 5}}, ipv6=True) as server:
+            message = runCheck(parseArgs(['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'metric,5', '--timings'])).getMessage()
+            self.assertTrue(message.startswith('OK'), message)
+            self.assertRegex(message, "'connect'=[0-9.]+ms ")
+
+    def test_response_cache(self):
+        cache_dir = self.tempdir()
+        with JsonServer({'/jmx': {"metric": 5}}) as server:
+            argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'metric,5', '--cache-ttl', '60', '--cache-dir', cache_dir, '--timings']
+            miss = runCheck(parseArgs(argv))
+            server.server.shutdown()
+            hit = runCheck(parseArgs(argv))
+        self.assertEqual(OK_CODE, hit.getCode())
+        self.assertIn("'cache_hit'=0;", miss.getMessage())
+        self.assertIn("'cache_hit'=1;", hit.getMessage())
+        # The download is timed once, while the cache fetches it, and a hit downloads nothing
+        self.assertEqual(1, len(re.findall("'download'=", miss.getMessage())))
+        self.assertNotIn("'download'=", hit.getMessage())
+        self.assertIn("'size'=13B", hit.getMessage())
+
+        cache = ResponseCache(cache_dir, 60, 10)
+        loads = []
+        for key in ('a', 'b', 'a'):
+            cache.fetch(key, lambda: loads.append(key) or b'12345678')
+        self.assertEqual(['a', 'b', 'a'], loads)
+        self.assertEqual(1, len([name for name in os.listdir(cache_dir) if name.endswith('.body')]))
+
+        # Bodies other users could have written are fetched again, an unusable directory is UNKNOWN
+        body = os.path.join(cache_dir, 'a.body')
+        os.chmod(body, 0o666)
+        self.assertEqual((b'fresh', False), cache.fetch('a', lambda: b'fresh')[:2])
+        self.assertEqual(0o600, os.stat(body).st_mode & 0o777)
+        with JsonServer({'/jmx': {"metric": 5}}) as server:
+            argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'metric,5', '--cache-ttl', '60']
+            nagios = runCheck(parseArgs(argv + ['--cache-dir', '/proc/nope']))
+            self.assertEqual(UNKNOWN_CODE, nagios.getCode())
+            self.assertIn('CacheError[', nagios.getMessage())
+            self.assertIn('cache:/proc/nope', nagios.getMessage())
+            self.assertIn('URLError', runCheck(parseArgs(['-H', server.host, '-P', '1', '--cache-ttl', '60', '--cache-dir', cache_dir])).getMessage())
+        self.assertTrue(cacheDirectory().endswith('check_http_json_cache-%d' % os.getuid()))
+
+    def test_output_budget(self):
+        formatted = []
+        def detail(i):
+            return lambda: formatted.append(i) or " Value for key k%d (%d) was in range '0 : 10'." % (i, i)
+        def helper(long_output=False, max_output=0):
+            nagios = NagiosHelper(long_output, max_output)
+            nagios.append_warning([' Value for key w (11) was outside the range \'0 : 10\'.'], [detail(i) for i in range(200)])
+            nagios.append_metrics(["'k%d'=%d;10;20 " % (i, i) for i in range(50)], '', '')
+            return nagios
+        unlimited = helper().getMessage()
+        self.assertEqual(200, len(formatted))
+        self.assertEqual(unlimited, helper(max_output=len(unlimited)).getMessage())
+
+        del formatted[:]
+        message = helper(max_output=2000).getMessage()
+        self.assertLessEqual(len(message.encode()), 2000)
+        self.assertTrue(message.startswith("WARNING: Value for key k0 (0) was in range"))
+        self.assertEqual(unlimited.split('|')[1], message.split('|')[1])
+        self.assertRegex(message, "was outside the range '0 : 10'. 1[0-9]{2} more details omitted.\\|")
+        # Only the details that fit were formatted, plus the one that did not
+        self.assertLess(len(formatted), 30)
+        message = helper(max_output=600).getMessage()
+        self.assertLessEqual(len(message.encode()), 600)
+        self.assertTrue(message.startswith("WARNING: 1 problems omitted.|'k0'=0;10;20 'k1'=1;10;20 "))
+        # All the performance data is kept when it fits next to the shortest note
+        message = "WARNING: 1 problems omitted.|" + unlimited.split('|')[1]
+        self.assertEqual(message, helper(max_output=len(message)).getMessage())
+        self.assertEqual(message.rsplit("'k49'", 1)[0], helper(max_output=len(message) - 1).getMessage())
+        # Without long text lines the performance data stays on the first line, where Nagios reads it
+        self.assertEqual(message.rstrip(), helper(long_output=True, max_output=len(message)).getMessage())
+        self.assertNotIn('checks passed', helper(long_output=True, max_output=200).getMessage())
+
+        lines = helper(long_output=True, max_output=3000).getMessage().split('\n')
+        self.assertEqual("WARNING: Value for key w (11) was outside the range '0 : 10'.", lines[0])
+        self.assertEqual("Value for key k0 (0) was in range '0 : 10'.", lines[1])
+        self.assertRegex(lines[-50], "^[0-9]+ more details omitted.\\|'k0'=0;10;20$")
+        self.assertEqual("'k49'=49;10;20", lines[-1])
+        nagios = NagiosHelper(True)
+        nagios.append_warning('', " Value for key a (1) does match 1.")
+        self.assertEqual("OK: 1 checks passed.\nValue for key a (1) does match 1.", nagios.getMessage())
+        nagios = NagiosHelper(True)
+        nagios.append_metrics(["'a'=1 'b'=2 ", "'c'=3 "], '', '')
+        self.assertEqual("OK: 0 checks passed.|'a'=1 'b'=2 'c'=3", nagios.getMessage())
+        nagios = NagiosHelper(True, 100)
+        nagios.append_warning('', [detail(i) for i in range(200)])
+        self.assertTrue(nagios.getMessage().startswith("OK: 200 checks passed.\n"))
+
+        # Single quotes in labels are doubled, so long output and node labels split the entries where they end
+        args = parseArgs(['-i', '-', '-m', "x'y", 'n', '-l'])
+        self.assertEqual(0, args.max_output)
+        nagios = NagiosHelper(True)
+        checkRules(args, {"x'y": 1, "n": 2}, nagios, Timings())
+        self.assertEqual("OK: 0 checks passed.|'x''y'=1 'n'=2", nagios.getMessage())
+        cluster = NagiosHelper()
+        cluster.include(nagios, "node'1")
+        self.assertEqual("OK:|'x''y(node''1)'=1 'n(node''1)'=2 ", cluster.getMessage())
+
+    def test_compression(self):
+        document = {"beans": [{"name": "bean%d" % i, "value": i} for i in range(2000)]}
+        argv = ['-p', 'jmx', '-w', 'beans(1999).value,0:2000', '--timings']
+        messages = []
+        for encoding in (None, 'gzip', 'deflate', 'raw'):
+            with JsonServer({'/jmx': document}, encoding) as server:
+                pool = ConnectionPool()
+                for stream in ([], ['--stream']):
+                    args = parseArgs(['-H', server.host, '-P', str(server.port)] + argv + stream)
+                    nagios = runCheck(args, pool)
+                    self.assertEqual(OK_CODE, nagios.getCode(), nagios.getMessage())
+                    size, wire = map(int, re.search("'size'=([0-9]+)B 'wire_size'=([0-9]+)B", nagios.getMessage()).groups())
+                    if encoding:
+                        self.assertLess(wire * 5, size)
+                    elif not stream:
+                        self.assertEqual(size, wire)
+                # The connection was drained and reused
+                self.assertEqual(1, len(pool.idle[('http', server.host, server.port)]))
+                pool.close()
+                nagios = runCheck(parseArgs(['-H', server.host, '-P', str(server.port), '--max-decoded-size', '50000'] + argv))
+                if encoding:
+                    self.assertIn('DecodingError[decoded body exceeds 50000 bytes]', nagios.getMessage())
+                messages.append(runCheck(parseArgs(['-H', server.host, '-P', str(server.port), '--no-compression'] + argv)).getMessage())
+        self.assertEqual(4, len([message for message in messages if "'wire_size'=" in message and message.startswith('OK')]))
+        with JsonServer({'/jmx': document}, {'br': lambda body: body}) as server:
+            nagios = runCheck(parseArgs(['-H', server.host, '-P', str(server.port), '-A', '{"Accept-Encoding": "br"}'] + argv))
+            self.assertIn('DecodingError[unsupported Content-Encoding br]', nagios.getMessage())
+
+    def test_json_backends(self):
+        backends = []
+        for backend in JSON_BACKENDS:
+            try:
+                backends.append(jsonDecoder(backend)[0])
+            except ImportError:
+                pass
+        self.assertEqual(backends[0], jsonDecoder()[0])
+        documents = [b'{"a": {"b": [1, 2.5, -0.0, 1e-7, 5e-324, true, null]}, "s": "\\u00e9\xc3\xa9", "a": 3}',
+                     b'[123456789012345678901234567890, 18446744073709551616, -9223372036854775809]',
+                     b'{"n": NaN, "i": Infinity, "big": 1e400}', b'"\\ud800"', b'\xef\xbb\xbf{"bom": 1}', b'{"u16": 1}'.decode().encode('utf-16')]
+        for backend in backends:
+            for document in documents:
+                expected, value = repr(json.loads(document)), repr(loadJson(document, backend))
+                self.assertEqual(expected, value, (backend, document))
+            self.assertRaises(ValueError, loadJson, b'{"a": ', backend)
+        # The decoder is picked per document, a large one leaves the small ones after it to json
+        decoders = dict(_decoders)
+        try:
+            _decoders[None] = ('fast', lambda body: 'fast')
+            self.assertEqual({"a": 1}, loadJson(b'{"a": 1}'))
+            self.assertEqual('fast', loadJson(b'{"a": 1}', size=FAST_DECODER_MIN_SIZE))
+        finally:
+            _decoders.clear()
+            _decoders.update(decoders)
+
+        path = os.path.join(self.tempdir(), 'data.json')
+        with open(path, 'wb') as f:
+            f.write(b'{"jmx": {"heap": 5, "big": 123456789012345678901234567890, "ratio": 0.1}, "status": "UP", "l": [1, 2, 3]}')
+        argv = ['-i', path, '-q', 'status,UP', 'jmx.big,123456789012345678901234567890', '-w', 'jmx.heap,1:10', '-m', 'jmx.ratio', 'l#sum']
+        messages = set(runCheck(parseArgs(argv + ['--json-backend', backend] + stream)).getMessage() for backend in backends for stream in ([], ['--stream']))
+        self.assertEqual(1, len(messages))
+
+    def test_rules_file(self):
+        directory = self.tempdir()
+        data, rules = os.path.join(directory, 'data.json'), os.path.join(directory, 'rules.json')
+        with open(data, 'w') as f:
+            json.dump({"jmx": {"heap": 5}, "status": "UP", "up": True}, f)
+        with open(rules, 'w') as f:
+            json.dump({"jmx.heap": {"alias": "heap", "warning": "1:10", "metric": {"uom": "B", "critical": 20, "min": 0}},
+                       "status": {"equals_critical": ["UP", "STARTING"]}, "up": {"equals": True, "exists_critical": True}}, f)
+        argv = ['-i', data, '--cache-dir', directory]
+        # Merged with the command line options, whose rules come first
+        nagios = runCheck(parseArgs(argv + ['-r', rules, '-w', 'jmx.heap,0:1']))
+        self.assertEqual(WARNING_CODE, nagios.getCode())
+        self.assertIn("Value for key jmx.heap (5) was outside the range '0 : 1'.", nagios.getMessage())
+        self.assertIn("Value for key up (True) does match True. Value for key status (UP) does match UP:STARTING.", nagios.getMessage())
+        self.assertTrue(nagios.getMessage().endswith("|'heap'=5B;;20;0 "))
+        self.assertEqual(1, len([name for name in os.listdir(directory) if name.endswith('.rules')]))
+
+        # Later checks load the compiled rules from disk, until the file changes
+        RuleProgram._compiled.clear()
+        compileFile, RuleProgram.compileFile = RuleProgram.compileFile, None
+        try:
+            self.assertEqual(nagios.getMessage(), runCheck(parseArgs(argv + ['-r', rules, '-w', 'jmx.heap,0:1'])).getMessage())
+        finally:
+            RuleProgram.compileFile = compileFile
+        # The program of a changed file replaces the one compiled from its previous version
+        programs = len(RuleProgram._compiled)
+        with open(rules, 'w') as f:
+            json.dump({"status": {"equals": "UP"}}, f)
+        message = runCheck(parseArgs(argv + ['-r', rules, '-w', 'jmx.heap,0:1'])).getMessage()
+        self.assertIn("Value for key status (UP) does match UP.", message)
+        self.assertNotIn("heap'=", message)
+        self.assertEqual(programs, len(RuleProgram._compiled))
+        memo = {}
+        for i in range(MEMO_SIZE + 1):
+            remember(memo, i, i)
+        self.assertEqual({MEMO_SIZE: MEMO_SIZE}, memo)
+        with open(rules, 'w') as f:
+            json.dump({"status": {"equals": "DOWN"}, "jmx.heap": {"metric": {"uom": "B", "warn": 1}}}, f)
+        self.assertIn('RulesError[Metric for key jmx.heap', runCheck(parseArgs(argv + ['-r', rules])).getMessage())
+        self.assertIn('RulesError', runCheck(parseArgs(argv + ['-r', rules + '.missing'])).getMessage())
+
+    def test_input(self):
+        path = os.path.join(self.tempdir(), 'status.json')
+        with open(path, 'w') as f:
+            json.dump({"jmx": {"heap": 5}, "status": "UP"}, f)
+        argv = ['-q', 'status,UP', '-w', 'jmx.heap,1:10', '-m', 'jmx.heap>heap']
+        nagios = runCheck(parseArgs(['-i', path] + argv))
+        self.assertEqual(OK_CODE, nagios.getCode())
+        self.assertEqual(nagios.getMessage(), runCheck(parseArgs(['-i', path, '--stream'] + argv)).getMessage())
+        self.assertIn('InputError', runCheck(parseArgs(['-i', path + '.missing'] + argv)).getMessage())
+        # A null document is a document, its rules still run
+        with open(path, 'w') as f:
+            f.write('null')
+        nagios = runCheck(parseArgs(['-i', path, '-E', 'status']))
+        self.assertEqual((CRITICAL_CODE, 'CRITICAL: Key status did not exist.'), (nagios.getCode(), nagios.getMessage().strip()))
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, parseArgs, ['-i', path, '-H', 'localhost'])
+
+        # stdin, and the HTTP stack stays unloaded
+        script = "import runpy, sys\nsys.argv.pop(0)\ntry: runpy.run_path(sys.argv[0], run_name='__main__')\nexcept SystemExit as e: print(e.code, 'http.client' in sys.modules, 'orjson' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', script, PLUGIN, '-i', '-', '-Q', 'status,DOWN'],
+            input=b'{"status": "UP"}', stdout=subprocess.PIPE)
+        self.assertEqual(b'CRITICAL', result.stdout[:8])
+        self.assertTrue(result.stdout.endswith(b'2 False False\n'))
+        result = subprocess.run([sys.executable, '-c', script, PLUGIN, '-i', '-', '-q', 'a,1'],
+            input=b'{"a": ', stdout=subprocess.PIPE)
+        self.assertIn(b'JSONError', result.stdout)
+
+        # The launcher finds the engine through a symlink, and copied alone it is UNKNOWN
+        directory = self.tempdir()
+        os.symlink(PLUGIN, os.path.join(directory, 'linked.py'))
+        result = subprocess.run([sys.executable, os.path.join(directory, 'linked.py'), '-i', '-', '-q', 'status,UP'],
+            input=b'{"status": "UP"}', stdout=subprocess.PIPE)
+        self.assertEqual((OK_CODE, b'OK'), (result.returncode, result.stdout[:2]))
+        shutil.copy(PLUGIN, os.path.join(directory, 'check_http_json.py'))
+        result = subprocess.run([sys.executable, os.path.join(directory, 'check_http_json.py'), '-i', '-', '-q', 'status,UP'],
+            input=b'{"status": "UP"}', stdout=subprocess.PIPE)
+        self.assertEqual(UNKNOWN_CODE, result.returncode)
+        self.assertIn(b'check_http_json_engine.py is missing', result.stdout)
+
+    def test_limits(self):
+        import socket
+        def trickle(head, body, delay):
+            """Serve one response, sending the body a byte at a time delay seconds apart"""
+            server = socket.socket()
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            def serve():
+                conn, _ = server.accept()
+                with conn:
+                    conn.recv(65536)
+                    try:
+                        conn.sendall(head if delay else head + body)
+                        for i in range(len(body) if delay else 0):
+                            conn.sendall(body[i:i + 1])
+                            time.sleep(delay)
+                        # Hold the connection open until the check hangs up
+                        conn.recv(1)
+                    except OSError:
+                        pass
+            threading.Thread(target=serve, daemon=True).start()
+            return server
+        body = b'{"metric": 5}'
+        head = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body)
+        with trickle(head, body, 0.2) as server:
+            started = time.monotonic()
+            nagios = runCheck(parseArgs(['-H', '127.0.0.1', '-P', str(server.getsockname()[1]), '-t', '1', '--deadline', '0.5', '-q', 'metric,5']))
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(CRITICAL_CODE, nagios.getCode())
+            self.assertTrue(nagios.getMessage().startswith('CRITICAL:DeadlineExceeded[0.5s], url:http://127.0.0.1:'))
+        # A redirect leaves the pool for urllib, which stays under the same deadline
+        with trickle(head, body, 0.2) as server, \
+                trickle(b'HTTP/1.1 302 Found\r\nLocation: http://127.0.0.1:%d/\r\nContent-Length: 0\r\n\r\n' % server.getsockname()[1], b'', 0) as redirect:
+            started = time.monotonic()
+            nagios = runCheck(parseArgs(['-H', '127.0.0.1', '-P', str(redirect.getsockname()[1]), '-t', '1', '--deadline', '0.5', '-q', 'metric,5']))
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertTrue(nagios.getMessage().startswith('CRITICAL:DeadlineExceeded[0.5s]'), nagios.getMessage())
+        # Bad ports, hosts and headers are reported as such, not as JSON errors
+        for extra in ([], ['--timings']):
+            self.assertIn("UNKNOWN:InvalidURL[", runCheck(parseArgs(['-H', '127.0.0.1', '-P', 'abc', '-q', 'metric,5'] + extra)).getMessage())
+            self.assertIn("UNKNOWN:InvalidURL[", runCheck(parseArgs(['-H', '127.0.0.1 x', '-q', 'metric,5'] + extra)).getMessage())
+        for headers in ('{bad', '[1]'):
+            self.assertTrue(runCheck(parseArgs(['-H', '127.0.0.1', '-P', '1', '-A', headers, '-q', 'metric,5'])).getMessage().startswith(
+                "UNKNOWN:HeadersError["))
+        # Stalled headers
+        with trickle(head[:20], b'', 0) as server:
+            nagios = runCheck(parseArgs(['-H', '127.0.0.1', '-P', str(server.getsockname()[1]), '-t', '10', '--deadline', '0.3', '-q', 'metric,5']))
+            self.assertIn('DeadlineExceeded', nagios.getMessage())
+        # Without Content-Length the body is counted while it is read
+        with trickle(b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n', b'[' + b'1,' * 50000, 0) as server:
+            nagios = runCheck(parseArgs(['-H', '127.0.0.1', '-P', str(server.getsockname()[1]), '--max-size', '1000', '-e', 'metric']))
+            self.assertEqual(UNKNOWN_CODE, nagios.getCode())
+            self.assertIn('ResponseTooLarge[body exceeds 1000 bytes]', nagios.getMessage())
+        document = {"metric": 5, "padding": "x" * 2000}
+        with JsonServer({'/jmx': document}, encoding='gzip') as server:
+            argv = ['-H', server.host, '-P', str(server.port), '-p', 'jmx', '-q', 'metric,5', '--max-size', '1000']
+            self.assertEqual(OK_CODE, runCheck(parseArgs(argv + ['--deadline', '5'])).getCode())
+            nagios = runCheck(parseArgs(argv + ['--no-compression']))
+            self.assertEqual(UNKNOWN_CODE, nagios.getCode())
+            self.assertIn('ResponseTooLarge[Content-Length %d exceeds 1000 bytes]' % len(json.dumps(document)), nagios.getMessage())
+
+    def test_lock_deadline(self):
+        def hold(path):
+            """Lock path exclusively from another process until it is killed"""
+            script = 'import fcntl, sys, time; f = open(sys.argv[1], "a"); fcntl.flock(f, fcntl.LOCK_EX); print(1, flush=True); time.sleep(60)'
+            holder = subprocess.Popen([sys.executable, '-c', script, path], stdout=subprocess.PIPE)
+            self.addCleanup(holder.wait)
+            self.addCleanup(holder.kill)
+            holder.stdout.readline()
+        cache_dir = self.tempdir()
+        args = parseArgs(['-H', '127.0.0.1', '-P', '1', '-p', 'jmx', '-e', 'metric', '--cache-ttl', '60', '--cache-dir', cache_dir, '--deadline', '0.5'])
+        cache = ResponseCache(cache_dir, 60, args.cache_max_size)
+        hold(os.path.join(cache_dir, cache.key(buildUrl(args, 'jmx'), args) + '.lock'))
+        for extra in ([], ['-t', '1', '--deadline', '10']):
+            started = time.monotonic()
+            nagios = runCheck(parseArgs(['-H', '127.0.0.1', '-P', '1', '-p', 'jmx', '-e', 'metric', '--cache-ttl', '60', '--cache-dir', cache_dir,
+                                         '--deadline', '0.5'] + extra))
+            self.assertLess(time.monotonic() - started, 1.5)
+            self.assertEqual(CRITICAL_CODE, nagios.getCode())
+            self.assertIn('DeadlineExceeded[', nagios.getMessage())
+
+        directory = self.tempdir()
+        path = os.path.join(directory, 'stats.json')
+        with open(path, 'w') as f:
+            json.dump({"requests": 100}, f)
+        argv = ['-i', path, '--state-dir', directory, '-m', 'requests#rate', '--deadline', '0.5']
+        hold(CounterStore.forArgs(parseArgs(argv)).path + '.lock')
+        started = time.monotonic()
+        nagios = runCheck(parseArgs(argv))
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(CRITICAL_CODE, nagios.getCode())
+        self.assertIn('DeadlineExceeded[0.5s, locked:', nagios.getMessage())
+
+    def test_counters(self):
+        directory = self.tempdir()
+        path = os.path.join(directory, 'stats.json')
+        argv = ['-i', path, '--state-dir', directory, '-w', 'requests#rate,0:4', '-m', 'requests#rate>requests', 'gc(*).count#delta>gc']
+        def check(document, seconds_later=10):
+            with open(path, 'w') as f:
+                json.dump(document, f)
+            state = CounterStore.forArgs(parseArgs(argv))
+            if os.path.exists(state.path):
+                # Move the previous check back in time
+                with open(state.path) as f:
+                    entries = json.load(f)
+                with open(state.path, 'w') as f:
+                    json.dump(dict((key, [value, then - seconds_later]) for key, (value, then) in entries.items()), f)
+            return runCheck(parseArgs(argv))
+        nagios = check({"requests": 100, "gc": {"young": {"count": 5}, "old": {"count": 1}}})
+        self.assertEqual(OK_CODE, nagios.getCode())
+        self.assertEqual('', ''.join(nagios.perfdata).strip())
+        nagios = check({"requests": 150, "gc": {"young": {"count": 8}, "old": {"count": 1}}})
+        self.assertEqual(WARNING_CODE, nagios.getCode())
+        # The 10 seconds moved back plus the time the checks took
+        self.assertRegex(nagios.getMessage(), r"\|'requests'=(4\.9\d*|5) 'gc\(young\)'=3 'gc\(old\)'=0 $")
+        # A restarted counter counts from zero
+        nagios = check({"requests": 20, "gc": {"young": {"count": 1}, "old": {"count": 2}}}, 5)
+        self.assertRegex(nagios.getMessage(), r"\|'requests'=(3\.9\d*|4) 'gc\(young\)'=1 'gc\(old\)'=1 $")
+        # Keys not seen within --state-ttl expire
+        nagios = check({"requests": 30}, 100000)
+        self.assertEqual(OK_CODE, nagios.getCode())
+        with open(CounterStore.forArgs(parseArgs(argv)).path) as f:
+            self.assertEqual(['requests'], list(json.load(f)))
+        # One file per target, whatever the rules
+        self.assertEqual(CounterStore.forArgs(parseArgs(argv)).path, CounterStore.forArgs(parseArgs(['-i', path, '--state-dir', directory])).path)
+        # Checks sending other POST data, headers or auth to the same URL keep their own counters
+        target = ['-H', 'localhost', '-p', 'stats', '--state-dir', directory, '-m', 'requests#rate']
+        paths = [CounterStore.forArgs(parseArgs(target + extra)).path
+                 for extra in ([], ['-D', '{"query": "a"}'], ['-D', '{"query": "b"}'], ['-A', '{"X-Tenant": "a"}'], ['-B', 'user:secret'])]
+        self.assertEqual(5, len(set(paths)))
+        # Values another user could have written are ignored
+        os.chmod(CounterStore.forArgs(parseArgs(argv)).path, 0o666)
+        nagios = check({"requests": 40})
+        self.assertEqual('', ''.join(nagios.perfdata).strip())
+        self.assertEqual(0o600, os.stat(CounterStore.forArgs(parseArgs(argv)).path).st_mode & 0o777)
+        state = os.path.dirname(CounterStore.forArgs(parseArgs(['-i', path])).path)
+        self.assertTrue(state.endswith('check_http_json_state-%d' % os.getuid()))
+        # A counter exists from its first check on, before it has a rate
+        with open(path, 'w') as f:
+            json.dump({"requests": 100, "gc": {"young": {"count": 5}}}, f)
+        exists = ['-i', path, '--state-dir', self.tempdir(), '-E', 'requests#rate', 'missing#rate', '-e', 'gc(*).count#delta']
+        for _ in range(2):
+            self.assertEqual("CRITICAL: Key missing#rate did not exist.", runCheck(parseArgs(exists)).getMessage())
+        # The rate and the delta of a key come from one stored sample and one walk
+        argv = ['-i', path, '--state-dir', self.tempdir(), '-m', 'requests#rate>rate', 'requests#delta>delta', 'requests']
+        check({"requests": 100})
+        with open(CounterStore.forArgs(parseArgs(argv)).path) as f:
+            self.assertEqual({'requests'}, set(json.load(f)))
+        nagios = check({"requests": 160})
+        self.assertRegex(nagios.getMessage(), r"\|'rate'=(5\.9\d*|6) 'delta'=60 'requests'=160 $")
+        helper = JsonHelper({"requests": 160}, '.')
+        program = RuleProgram.fromArgs(parseArgs(argv))
+        program.evaluate(helper, CounterStore.forArgs(parseArgs(argv)))
+        self.assertEqual(1, helper.walks)
+
+    def test_unix_socket(self):
+        path = os.path.join(self.tempdir(), 'status.sock')
+        with JsonServer({'/status': {"status": "UP", "queue": 3}}, unix_socket=path) as server:
+            argv = ['-U', path, '-p', 'status', '-q', 'status,UP', '-m', 'queue']
+            pool = ConnectionPool()
+            nagios = runCheck(parseArgs(argv), pool)
+            self.assertEqual("OK: Value for key status (UP) does match UP.|'queue'=3 ", nagios.getMessage())
+            nagios = runCheck(parseArgs(argv + ['-H', 'status.local', '-B', 'user:secret', '-D', 'query']), pool)
+            self.assertEqual(OK_CODE, nagios.getCode())
+            self.assertEqual([('GET', 'localhost', None), ('POST', 'status.local', 'Basic dXNlcjpzZWNyZXQ=')], server.server.requests)
+            # Both checks went over one kept-alive connection
+            self.assertEqual(1, len(pool.idle[('unix', path, None)]))
+            pool.close()
+            message = runCheck(parseArgs(argv + ['--timings'])).getMessage()
+            self.assertRegex(message, "'connect'=[0-9.]+ms ")
+            self.assertNotIn("'dns'", message)
+            nagios = runCheck(parseArgs(argv[:2] + ['-p', 'missing', '-q', 'status,UP']))
+            self.assertEqual('UNKNOWN:HTTPError[404], url:http://localhost/missing, socket:%s' % path, nagios.getMessage())
+        nagios = runCheck(parseArgs(argv))
+        self.assertEqual(CRITICAL_CODE, nagios.getCode())
+        self.assertIn('socket:%s' % path, nagios.getMessage())
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, parseArgs, argv + ['-s'])
+
+    def test_ndjson(self):
+        import tracemalloc
+        records = [{"partition": i, "lag": i * 10, "status": "ERROR" if i % 4 == 0 else "OK", "tags": ["a", "b"]} for i in range(1, 9)]
+        records.append({"partition": 9, "status": "OK"})
+        body = b'\n'.join(json.dumps(record).encode() for record in records) + b'\n\n'
+        argv = ['--ndjson', '-w', '(*).lag#max,0:70', '-c', '(*).status#count=ERROR,0:2',
+                '-m', '(*)#count>records', '(*).lag#avg>lag', '(*).lag#sum', '(*).tags(*)#count>tags', '(*).missing#min']
+        with JsonServer({'/feed': body}, encoding='gzip') as server:
+            nagios = runCheck(parseArgs(['-H', server.host, '-P', str(server.port), '-p', 'feed'] + argv))
+        self.assertEqual(WARNING_CODE, nagios.getCode())
+        self.assertEqual("WARNING: Value for key (*).status#count=ERROR (2) was in range '0 : 2'. Value for key (*).lag#max (80) was outside the range '0 : 70'."
+            "|'records'=9 'lag'=45 '(*).lag#sum'=360 'tags'=16  ", nagios.getMessage())
+        # The same aggregates as over a JSON array
+        processor = JsonRuleProcessor(records, parseArgs(['-i', '-'] + argv[1:]))
+        self.assertEqual(''.join(nagios.perfdata), processor.checkMetrics()[0])
+
+        path = os.path.join(self.tempdir(), 'feed.ndjson')
+        with open(path, 'wb') as f:
+            f.write(body + b'{"lag": \n')
+        nagios = runCheck(parseArgs(['-i', path] + argv))
+        self.assertEqual(UNKNOWN_CODE, nagios.getCode())
+        self.assertIn('JSONError[line 11: ', nagios.getMessage())
+        nagios = runCheck(parseArgs(['-i', path, '--ndjson', '-w', '(*).lag#p95,10']))
+        self.assertTrue(nagios.getMessage().startswith('UNKNOWN:RulesError[key (*).lag#p95 does not reduce the records'))
+
+        # Memory stays flat however many records there are
+        body = b''.join(b'{"id": %d, "lag": %d, "status": "OK", "padding": "%s"}\n' % (i, i % 100, b'x' * 100) for i in range(20000))
+        stream = io.BytesIO(body)
+        tracemalloc.start()
+        try:
+            aggregates = RecordAggregates(['(*).lag#max', '(*).status#count=OK', '(*).id#sum'], '.').feed(stream)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual((99, 20000, 199990000), tuple(aggregates.get(key) for key in ('(*).lag#max', '(*).status#count=OK', '(*).id#sum')))
+        self.assertLess(peak, len(body) / 8)
+
+        # Lines go to the fast decoder once the stream is large, without switching other documents to it
+        decoders = dict(_decoders)
+        fast = []
+        try:
+            _decoders[None] = ('fast', lambda line: fast.append(line) or json.loads(line))
+            line = b'{"lag": 1, "padding": "%s"}' % (b'x' * 4000)
+            lines = FAST_DECODER_MIN_SIZE // len(line) + 100
+            aggregates = RecordAggregates(['(*).lag#sum'], '.').feed(io.BytesIO(b'\n'.join([line] * lines)))
+            self.assertEqual(lines, aggregates.get('(*).lag#sum'))
+            self.assertTrue(100 <= len(fast) < 200, len(fast))
+            del fast[:]
+            loadJson(line)
+            self.assertEqual([], fast)
+        finally:
+            _decoders.clear()
+            _decoders.update(decoders)
+
+    def test_trace(self):
+        directory = self.tempdir()
+        path = os.path.join(directory, 'status.json')
+        with open(path, 'w') as f:
+            json.dump({"beans": [{"name": "a", "value": 1}, {"name": "b", "value": 20}], "gc": {"young": 4, "old": 2},
+                       "status": "UP", "unread": list(range(100))}, f)
+        name = base64.b64encode(b'b').decode()
+        argv = ['-i', path, '-q', 'status,UP', '-w', 'beans(name=%s).value,0:10' % name, 'gc(*)#max,0:10', '-m', 'gc(*)']
+        trace = os.path.join(directory, 'trace.json')
+        for _ in range(2):
+            nagios = runCheck(parseArgs(argv + ['--trace', trace]))
+        self.assertEqual(WARNING_CODE, nagios.getCode())
+        with open(trace) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(2, len(lines))
+        report = json.loads(lines[1])
+        self.assertEqual(path, report['target'])
+        keys = dict((entry['key'], entry) for entry in report['keys'])
+        self.assertEqual(['beans(name=%s).value' % name, 'gc(*)#max', 'status', 'gc(*)'], list(keys))
+        self.assertEqual((1, 1, 1), tuple(keys['beans(name=%s).value' % name][field] for field in ('walks', 'matches', 'floats')))
+        self.assertEqual((1, 2, 3), tuple(keys['gc(*)#max'][field] for field in ('walks', 'matches', 'floats')))
+        self.assertEqual((1, 2, 0), tuple(keys['gc(*)'][field] for field in ('walks', 'matches', 'floats')))
+        self.assertEqual(0, keys['status']['floats'])
+        self.assertEqual([('warning', 'EqualityRule', 'status')], [(r['level'], r['rule'], r['alias']) for r in keys['status']['rules']])
+        self.assertEqual({'keys': 4, 'rules': 4, 'walks': 4, 'matches': 6, 'floats': 4},
+                         dict((field, report['totals'][field]) for field in ('keys', 'rules', 'walks', 'matches', 'floats')))
+        self.assertIn('parse', report['phases'])
+        # Tracing measures the same work, the result does not change
+        self.assertEqual(runCheck(parseArgs(argv)).getMessage(), nagios.getMessage())
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            runCheck(parseArgs(argv + ['--trace']))
+        self.assertEqual(4, len(json.loads(stderr.getvalue())['keys']))
+        # Counting the matches of an aggregate reuses the values the evaluation reduced
+        from unittest import mock
+        program = RuleProgram.fromArgs(parseArgs(argv))
+        with open(path) as f:
+            helper = JsonHelper(json.load(f), '.')
+        walk = JsonPath.walk
+        with mock.patch.object(JsonPath, 'walk', autospec=True, side_effect=walk) as walks:
+            program.evaluate(helper, trace=EngineTrace(program))
+        self.assertEqual(4, len([call for call in walks.call_args_list if call[0][0].key in program.keys and call[0][2] == 0]))
+
+        # --debug only shows what the rules reach, array elements by index
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            runCheck(parseArgs(argv + ['-d']))
+        self.assertIn("{'beans': {1: {'value': 20}}, 'gc': {'old': 2, 'young': 4}, 'status': 'UP'}", stdout.getvalue())
+        self.assertNotIn('unread', stdout.getvalue())
+
+        profile = os.path.join(directory, 'check.prof')
+        result = subprocess.run([sys.executable, PLUGIN, '--profile', profile] + argv, stdout=subprocess.PIPE)
+        self.assertEqual(WARNING_CODE, result.returncode)
+        import pstats
+        self.assertTrue(any(function[2] == 'runCheck' for function in pstats.Stats(profile).stats))
+
+    def test_cluster(self):
+        import socket
+        stats = [{"ring_ready": True, "node_gets": 10, "node_get_fsm_time_95": 900},
+                 {"ring_ready": True, "node_gets": 20, "node_get_fsm_time_95": 1500},
+                 {"ring_ready": False, "node_gets": 30, "node_get_fsm_time_95": 700}]
+        with JsonServer({'/stats': stats[0]}) as a, JsonServer({'/stats': stats[1]}) as b, JsonServer({'/stats': stats[2]}) as c, \
+                socket.socket() as slow, socket.socket() as slower:
+            # Accepted by the kernel but never answered
+            for server in (slow, slower):
+                server.bind(('127.0.0.1', 0))
+                server.listen(4)
+            hosts = ['%s:%d' % (server.host, server.port) for server in (a, b, c)]
+            argv = ['-H', ','.join(hosts[:2]), '-H', hosts[2], '-p', 'stats', '-t', '1']
+            nagios = runCheck(parseArgs(argv + ['-Q', 'ring_ready,True', '-m', 'node_gets']))
+            self.assertEqual(CRITICAL_CODE, nagios.getCode())
+            # The quorum line decides the state, so it leads the output
+            self.assertTrue(nagios.getMessage().startswith("CRITICAL: 2 of 3 nodes OK, quorum 3. %s: Value for key ring_ready (True) does match True." % hosts[0]))
+            self.assertIn(" %s: Value for key ring_ready (False) did not match True." % hosts[2], nagios.getMessage())
+            self.assertIn("|'node_gets(%s)'=10 'node_gets(%s)'=20 'node_gets(%s)'=30 " % tuple(hosts), nagios.getMessage())
+            nagios = runCheck(parseArgs(argv + ['-Q', 'ring_ready,True', '-l']))
+            self.assertEqual("CRITICAL: 2 of 3 nodes OK, quorum 3. %s: Value for key ring_ready (False) did not match True." % hosts[2],
+                             nagios.getMessage().split('\n')[0])
+            nagios = runCheck(parseArgs(argv + ['-Q', 'ring_ready,True', '--quorum', '2']))
+            self.assertEqual(OK_CODE, nagios.getCode())
+
+            aggregate = argv + ['--aggregate', '-c', '(*).node_get_fsm_time_95#max,0:1000', '-m', '(*).node_get_fsm_time_95#max>fsm_max', '--stream']
+            nagios = runCheck(parseArgs(aggregate))
+            self.assertEqual(CRITICAL_CODE, nagios.getCode())
+            self.assertIn("'fsm_max'=1500 ", nagios.getMessage())
+
+            # Two nodes time out together, within one timeout
+            dead = ['127.0.0.1:%d' % server.getsockname()[1] for server in (slow, slower)]
+            started = time.monotonic()
+            nagios = runCheck(parseArgs(['-H', ','.join([hosts[0]] + dead + [hosts[2]]), '-p', 'stats', '-t', '1', '--quorum', '2',
+                '--aggregate', '-c', '(*).node_get_fsm_time_95#max,0:1000', '-m', '(*).node_gets#sum>gets']))
+            self.assertLess(time.monotonic() - started, 1.9)
+            self.assertEqual(OK_CODE, nagios.getCode())
+            self.assertIn("'gets'=40 ", nagios.getMessage())
+            self.assertIn("%s: URLError" % dead[0], nagios.getMessage())
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(SystemExit, parseArgs, argv + ['--quorum', '4'])
+                # A single host has no cluster to aggregate or count
+                for option in (['--quorum', '1'], ['--aggregate']):
+                    self.assertRaises(SystemExit, parseArgs, ['-H', hosts[0], '-q', 'ring_ready,True'] + option)
+
+
+if __name__ == "__main__":
+    unittest.main()